@@ -0,0 +1,505 @@
+# 效能量測：用記憶體裡的假 Google 試算表 + 本機 SMTP 收信器跑 booking_app.py，不需要任何憑證
+#   python benchmark.py                                # 預設 100 / 1,000 / 10,000 / 100,000 列、4 個 session
+#   python benchmark.py --rows 1000 --sessions 1 8 --latency 150 --memory --json result.json
+# 每個 session 是一個 AppTest；AppTest 不能多執行緒同時跑，所以 N 個 session 輪流重跑，
+# 共用同一個行程的快取與後端 (跟正式環境一個 Streamlit 行程服務多個使用者一樣)。
+# 之後再用 --threads 個執行緒同時直接呼叫 app 的函式 (讀快照、衝突檢查、行事曆、寫入)，
+# 量讀取合併、API 權杖桶在突發流量下、快照鎖爭用的表現，結果另外列一張表
+import argparse
+import ast
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter
+from datetime import date, timedelta
+
+import gspread
+import numpy as np
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "booking_app.py")
+HEADER = ["日期", "開始時間", "結束時間", "大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態", "編號"]
+ROOMS = ["小會議室", "大會議室", "洽談室Ａ", "洽談室Ｂ", "行銷部辦公室", "崇德門市", "生產中心", "物流中心", "線上", "外部"]
+MOODS = ["😀 超棒", "😐 平靜", "😫 累累"]
+DIRECT_WRITE_EVERY = 5  # 直接呼叫時每幾輪寫入一筆預約
+
+# --- 🧪 假的 gspread (只實作 booking_app 用到的部分) ---
+def _col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+A1_PATTERN = re.compile(r"[A-Z]*[0-9]*(:[A-Z]*[0-9]*)?")
+
+def _parse_range(rng):
+    # "'Sheet1'!A1:B4" -> (title, r0, c0, r1, c1)；r1 / c1 為 None 代表到底
+    # 沒有「!」的是整張工作表 ("'Sheet1'") 或目前工作表上的 A1 範圍 ("A2:B4"，title 為 None)
+    title, _, a1 = rng.partition("!")
+    if not a1 and A1_PATTERN.fullmatch(title):
+        title, a1 = None, title
+    elif title:
+        title = title.strip("'")
+    if not a1:
+        return title, 0, 0, None, None
+    cells = []
+    for part in a1.split(":"):
+        letters = part.rstrip("0123456789")
+        digits = part[len(letters):]
+        cells.append((int(digits) - 1 if digits else None, _col_index(letters) if letters else None))
+    (r0, c0), (r1, c1) = cells[0], cells[-1]
+    return title, r0 or 0, c0 or 0, None if r1 is None else r1 + 1, None if c1 is None else c1 + 1
+
+def _cell(value):
+    return next(iter(value.get("userEnteredValue", {"": ""}).values()))
+
+def _cell_rows(rows):
+    return [[_cell(c) for c in row.get("values", [])] for row in rows]
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.row_count = rows
+        self.col_count = cols
+        self.data = []
+
+    def read(self, r0=0, c0=0, r1=None, c1=None, formulas=False):
+        rows = [row[c0:c1] for row in self.data[r0:r1]]
+        if self.title == "Moods" and not formulas:
+            rows = [[self.spreadsheet.evaluate(v) for v in row] for row in rows]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+    def write(self, r0, c0, values):
+        for i, row in enumerate(values):
+            while len(self.data) <= r0 + i:
+                self.data.append([])
+            target = self.data[r0 + i]
+            for j, v in enumerate(row):
+                while len(target) <= c0 + j:
+                    target.append("")
+                target[c0 + j] = str(v)
+
+    def append(self, rows):
+        while self.data and not any(self.data[-1]):
+            self.data.pop()
+        self.data.extend([str(v) for v in row] for row in rows)
+
+    def get_all_values(self, *args, **kwargs):
+        self.spreadsheet.client.call("get_all_values")
+        return self.read()
+
+    def update(self, range_name, values, **kwargs):
+        self.spreadsheet.client.call("update")
+        _, r0, c0, _, _ = _parse_range(range_name)
+        self.write(r0, c0, values)
+
+class FakeSpreadsheet:
+    def __init__(self, client):
+        self.client = client
+        self.sheets = {}
+        self.lock = threading.Lock()
+
+    def evaluate(self, value):
+        # Moods 的票數是「常數 + COUNTIF('MoodVotes'!B:B,"心情")」
+        if "+COUNTIF(" not in value:
+            return value
+        base, rest = value[1:].split("+COUNTIF(", 1)
+        mood = rest.rsplit(',"', 1)[1][:-2]
+        votes = sum(1 for row in self.sheets["MoodVotes"].data if len(row) > 1 and row[1] == mood)
+        return str(int(base) + votes)
+
+    def _by_id(self, sheet_id):
+        return next(ws for ws in self.sheets.values() if ws.id == sheet_id)
+
+    def worksheets(self, *args, **kwargs):
+        self.client.call("worksheets")
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        self.client.call("worksheet")
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26, index=None, _count=True):
+        if _count:
+            self.client.call("add_worksheet")
+        ws = self.sheets[title] = FakeWorksheet(self, title, len(self.sheets), rows, cols)
+        return ws
+
+    def _read(self, rng, params=None):
+        title, *bounds = _parse_range(rng)
+        formulas = (params or {}).get("valueRenderOption") == "FORMULA"
+        with self.lock:
+            return {"range": rng, "values": self.sheets[title].read(*bounds, formulas=formulas)}
+
+    def values_get(self, rng, params=None):
+        self.client.call("values_get")
+        return self._read(rng, params)
+
+    def values_batch_get(self, ranges, params=None):
+        self.client.call("values_batch_get")
+        return {"valueRanges": [self._read(rng) for rng in ranges]}
+
+    def batch_update(self, body):
+        self.client.call("batch_update")
+        with self.lock:
+            for request in body.get("requests", []):
+                (kind, spec), = request.items()
+                if kind == "updateCells":
+                    rng = spec["range"]
+                    ws = self._by_id(rng["sheetId"])
+                    if rng.get("endColumnIndex", 0) > ws.col_count:
+                        raise gspread.exceptions.GSpreadException("exceeds grid limits")
+                    ws.write(rng["startRowIndex"], rng.get("startColumnIndex", 0), _cell_rows(spec["rows"]))
+                elif kind == "appendCells":
+                    self._by_id(spec["sheetId"]).append(_cell_rows(spec["rows"]))
+                elif kind == "deleteDimension":
+                    rng = spec["range"]
+                    del self._by_id(rng["sheetId"]).data[rng["startIndex"]:rng["endIndex"]]
+                elif kind == "appendDimension":
+                    ws = self._by_id(spec["sheetId"])
+                    if spec["dimension"] == "COLUMNS":
+                        ws.col_count += spec["length"]
+                    else:
+                        ws.row_count += spec["length"]
+                else:
+                    raise NotImplementedError(kind)
+        return {"replies": []}
+
+class FakeClient:
+    def __init__(self, latency=0.0):
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.latency = latency
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def call(self, name):
+        with self.calls_lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)  # 模擬一次 API 來回
+
+    def open_by_url(self, url):
+        self.call("open_by_url")
+        return self.spreadsheet
+
+def build_spreadsheet(client, n_rows, seed=0):
+    # 當月起往後排的預約 (不會被每日封存搬走)，加上已經建好的 Meta / Jokes / Moods / MoodVotes
+    rng = random.Random(seed)
+    sh = client.spreadsheet
+    first = date.today().replace(day=1)
+    bookings = sh.add_worksheet("Sheet1", cols=len(HEADER), _count=False)
+    bookings.data = [list(HEADER)]
+    for i in range(n_rows):
+        start = rng.randrange(16) * 30 + 8 * 60
+        end = start + rng.choice([30, 60, 90])
+        bookings.data.append([
+            (first + timedelta(days=rng.randrange(max(n_rows // 50, 30)))).isoformat(),
+            f"{start // 60:02d}:{start % 60:02d}:00",
+            f"{end // 60:02d}:{end % 60:02d}:00",
+            f"同事{i % 97}",
+            "",
+            rng.choice(ROOMS),
+            f"會議 {i}",
+            "2024-01-01 00:00:00",
+            rng.choice(["核准", "核准", "待審核", "拒絕"]),
+            f"{i:012x}",
+        ])
+    sh.add_worksheet("Jokes", _count=False).data = [["Joke Content"]] + [[f"笑話 {i}"] for i in range(20)]
+    sh.add_worksheet("MoodVotes", _count=False).data = [["Time", "Mood"]]
+    moods = [[m, f"=0+COUNTIF('MoodVotes'!B:B,\"{m}\")"] for m in MOODS]
+    sh.add_worksheet("Moods", _count=False).data = [["Mood", "Count"]] + moods
+    parts = ["bookings", "jokes", "moods", "archive"]
+    sh.add_worksheet("Meta", cols=2, _count=False).data = [[part, "seed"] for part in parts]
+
+# --- 📮 本機 SMTP 收信器 ---
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.reply("220 benchmark sink")
+        for line in iter(self.rfile.readline, b""):
+            command = line.decode(errors="replace").strip().upper()
+            if command == "DATA":
+                self.reply("354 end with <CRLF>.<CRLF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data.rstrip(b"\r\n") == b".":
+                        break
+                    size += len(data)
+                self.server.messages.append(size)
+                self.reply("250 queued")
+            elif command == "QUIT":
+                return self.reply("221 bye")
+            else:
+                self.reply("250 ok")  # EHLO / HELO / MAIL / RCPT / NOOP / RSET
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.messages = []
+        threading.Thread(target=self.serve_forever, daemon=True, name="smtp-sink").start()
+
+# --- 🧵 直接呼叫 app 函式 ---
+def _is_definition(node):
+    # import、函式、類別、常數 (與時段選項的迴圈) 留下；其餘頂層敘述是在畫頁面
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef, ast.For)):
+        return True
+    if not isinstance(node, ast.Assign):
+        return False
+    return all(isinstance(t, ast.Name) and (t.id.isupper() or t.id.endswith("_log")) for t in node.targets)
+
+def load_app():
+    # 只執行 booking_app.py 的定義、不畫頁面，多個執行緒可以同時呼叫裡面的函式
+    with open(APP, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), APP)
+    app = types.ModuleType("booking_app_direct")
+    app.__file__ = APP
+    body = [node for node in tree.body if _is_definition(node)]
+    exec(compile(ast.Module(body=body, type_ignores=[]), APP, "exec"), app.__dict__)
+    # 跟 AppTest 的 session 一樣走試算表後端 (gspread 已換成假的)
+    app._has_google_credentials = lambda: True
+    app._service_account_info = lambda: {"type": "service_account"}
+    return app
+
+# --- 🏃 情境 ---
+class Session:
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.app = AppTest.from_file(APP, default_timeout=bench.timeout)
+        self.app.secrets["service_account"] = {"type": "service_account"}
+        self.app.secrets["email"] = {
+            "sender": "bench@example.com",
+            "receiver": "team@example.com",
+            "smtp_host": "127.0.0.1",
+            "smtp_port": bench.sink.server_address[1],
+            "starttls": False,
+            "outbox_path": bench.outbox_path,
+        }
+
+    def run(self, phase):
+        before = sum(self.bench.client.calls.values())
+        started = time.perf_counter()
+        self.app.run()
+        elapsed = time.perf_counter() - started
+        if self.app.exception:
+            raise RuntimeError(f"{phase}: {self.app.exception[0].message}")
+        self.bench.record(phase, elapsed, sum(self.bench.client.calls.values()) - before)
+
+    def widget(self, kind, label):
+        return next(w for w in getattr(self.app, kind) if w.label == label)
+
+    def click(self, label, phase):
+        self.widget("button", label).click()
+        self.run(phase)
+
+    def submit_booking(self):
+        self.widget("text_input", "預約人大名 (必填)").input(f"壓測{self.index}")
+        self.widget("text_input", "內容 (必填)").input("效能量測")
+        self.widget("date_input", "日期").set_value(date.today() + timedelta(days=1 + self.index % 20))
+        self.widget("selectbox", "地點").set_value(ROOMS[self.index % len(ROOMS)])
+        self.click("送出", "送出預約")
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.timeout = args.timeout
+        self.sink = SMTPSink()
+        self.outbox_path = os.path.join(tempfile.mkdtemp(prefix="booking-bench-"), "outbox.sqlite3")
+        self.client = None
+        self.samples = {}
+        self.app = load_app() if any(args.threads) else None
+
+    def record(self, phase, seconds, calls):
+        self.samples.setdefault(phase, []).append((seconds, calls))
+
+    def scenario(self, n_rows, n_sessions):
+        # 每個情境都從冷的行程快取開始
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        self.client = FakeClient(self.args.latency / 1000)
+        build_spreadsheet(self.client, n_rows)
+        gspread.service_account_from_dict = lambda info, **kwargs: self.client
+        self.samples = {}
+        mails = len(self.sink.messages)
+        if self.args.memory:
+            tracemalloc.start()
+
+        sessions = [Session(self, i) for i in range(n_sessions)]
+        sessions[0].run("冷啟動")
+        for s in sessions[1:]:
+            s.run("新 session")
+        for _ in range(self.args.reruns):
+            for s in sessions:
+                s.run("重跑")
+        for s in sessions:
+            s.submit_booking()
+        for s in sessions:
+            s.app.session_state["calendar_date"] = (date.today() + timedelta(days=7)).isoformat()
+            s.run("換週")
+        for s in sessions:
+            s.click(MOODS[s.index % len(MOODS)], "心情投票")
+        for s in sessions[:2]:
+            s.widget("text_input", "輸入笑話內容").input(f"壓測笑話 {s.index}")
+            s.click("➕ 送出笑話", "投稿笑話")
+        admin = sessions[0]
+        admin.app.sidebar.text_input[0].input("8888")
+        admin.run("後台")
+        admin.click("✅ 核准 (衝突者拒絕)", "批次核准")
+        api_calls = dict(self.client.calls)
+        direct = [self.direct(n_threads) for n_threads in self.args.threads if n_threads]
+
+        peak = None
+        if self.args.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        time.sleep(self.args.settle)  # 等背景的心情寫入與寄信佇列送完
+        return {
+            "rows": n_rows,
+            "sessions": n_sessions,
+            "peak_mb": None if peak is None else round(peak / 2 ** 20, 1),
+            "api_calls": api_calls,
+            "mails": len(self.sink.messages) - mails,
+            "phases": {phase: summarize(samples) for phase, samples in self.samples.items()},
+            "direct": direct,
+        }
+
+    def direct(self, n_threads):
+        # N 個執行緒同時起跑、各自重複「讀快照 -> 衝突檢查 -> 行事曆」，每幾輪寫入一筆。
+        # 每次都從新的後端 (冷快照) 開始：第一波讀取會同時打進來，看 single-flight 有沒有合併
+        app = self.app
+        app._sheets_backend.clear()
+        barrier = threading.Barrier(n_threads)
+        lock = threading.Lock()
+        samples = {}
+        failed = []
+
+        def timed(op, fn, *args):
+            started = time.perf_counter()
+            value = fn(*args)
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.setdefault(op, []).append(elapsed)
+            return value
+
+        def worker(index):
+            rnd = random.Random(index)
+            barrier.wait()
+            for step in range(self.args.thread_ops):
+                snapshot = timed("讀快照", app.load_snapshot)
+                day = date.today() + timedelta(days=1 + rnd.randrange(20))
+                room = rnd.choice(ROOMS)
+                timed("衝突檢查", app.check_overlap, snapshot, day, app.time(9), app.time(10), room)
+                frame = app._calendar_frame(snapshot.bookings, snapshot.version)
+                timed("行事曆", app.week_events, [frame], app.week_anchor(day.isoformat()), False)
+                if step % DIRECT_WRITE_EVERY == 0:
+                    row = {
+                        "日期": day.isoformat(),
+                        "開始時間": "13:00:00",
+                        "結束時間": "14:00:00",
+                        "大名": f"執行緒 {index}",
+                        "會議地點": room,
+                        "預約內容": "效能量測",
+                        "登記時間": time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "狀態": "待審核",
+                    }
+                    if not timed("寫入預約", app.apply_booking_changes, [row]):
+                        failed.append(index)
+
+        before = Counter(self.client.calls)
+        threads = [threading.Thread(target=worker, args=(i,), name=f"bench-{i}") for i in range(n_threads)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        ops = sum(len(v) for v in samples.values())
+        return {
+            "threads": n_threads,
+            "seconds": round(elapsed, 2),
+            "ops_per_s": round(ops / elapsed, 1),
+            "failed_writes": len(failed),
+            "api_calls": dict(Counter(self.client.calls) - before),
+            "ops": {op: latency(seconds) for op, seconds in samples.items()},
+        }
+
+def latency(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "count": len(ms),
+        "p50_ms": round(float(np.percentile(ms, 50)), 1),
+        "p99_ms": round(float(np.percentile(ms, 99)), 1),
+    }
+
+def summarize(samples):
+    stats = latency([s for s, _ in samples])
+    calls = np.array([c for _, c in samples])
+    return {
+        "reruns": stats["count"],
+        "p50_ms": stats["p50_ms"],
+        "p99_ms": stats["p99_ms"],
+        "calls_per_rerun": round(float(calls.mean()), 2),
+    }
+
+def print_result(result):
+    memory = f"，Python 配置峰值 {result['peak_mb']} MB" if result["peak_mb"] is not None else ""
+    print(f"\n== {result['rows']:,} 列 × {result['sessions']} 個 session{memory}，寄出 {result['mails']} 封信")
+    print(f"{'階段':<10}{'次數':>6}{'p50 ms':>10}{'p99 ms':>10}{'API/次':>9}")
+    for phase, s in result["phases"].items():
+        print(f"{phase:<10}{s['reruns']:>6}{s['p50_ms']:>10}{s['p99_ms']:>10}{s['calls_per_rerun']:>9}")
+    print("API 呼叫：" + "、".join(f"{k} {v}" for k, v in sorted(result["api_calls"].items())))
+    for run in result["direct"]:
+        print(f"\n-- {run['threads']} 個執行緒直接呼叫：{run['seconds']} 秒、每秒 {run['ops_per_s']} 次，"
+              f"寫入失敗 {run['failed_writes']} 次")
+        print(f"{'操作':<10}{'次數':>6}{'p50 ms':>10}{'p99 ms':>10}")
+        for op, s in run["ops"].items():
+            print(f"{op:<10}{s['count']:>6}{s['p50_ms']:>10}{s['p99_ms']:>10}")
+        print("API 呼叫：" + "、".join(f"{k} {v}" for k, v in sorted(run["api_calls"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description="booking_app 效能量測 (假試算表 + 本機 SMTP)")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="Sheet1 的預約筆數")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[4], help="同時在線的 session 數")
+    parser.add_argument("--reruns", type=int, default=5, help="每個 session 的一般重跑次數")
+    parser.add_argument("--threads", type=int, nargs="+", default=[8], help="直接呼叫 app 函式的執行緒數 (0 = 不跑)")
+    parser.add_argument("--thread-ops", type=int, default=20, help="每個執行緒重複幾輪")
+    parser.add_argument("--latency", type=float, default=0, help="每次 API 呼叫模擬的來回延遲 (ms)")
+    parser.add_argument("--memory", action="store_true", help="用 tracemalloc 量 Python 配置峰值 (會讓時間變慢)")
+    parser.add_argument("--settle", type=float, default=4, help="每個情境結束後等背景寫入的秒數")
+    parser.add_argument("--timeout", type=float, default=600, help="單次重跑的逾時秒數")
+    parser.add_argument("--json", help="把結果另存成 JSON")
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(APP))
+    bench = Benchmark(args)
+    results = []
+    for n_rows in args.rows:
+        for n_sessions in args.sessions:
+            results.append(bench.scenario(n_rows, n_sessions))
+            print_result(results[-1])
+            sys.stdout.flush()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,28 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, time, timedelta
-from streamlit_calendar import calendar
-import gspread
-from gspread_dataframe import set_with_dataframe, get_as_dataframe
-from PIL import Image
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import numpy as np
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta
 import random
+import io
+import uuid
+from dataclasses import dataclass, replace
 import os
+import threading
+import sqlite3
+import atexit
 import time as time_module # 避免與 datetime.time 衝突
+import json
+import logging
+import functools
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+# gspread / google-auth / PIL / smtplib / streamlit_calendar 較重，在用到的地方才 import
 
 # --- ⚠️ 你的網址 ---
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1mpVm9tTWO3gmFx32dKqtA5_xcLrbCmGN6wDMC1sSjHs/edit"
@@ -35,6 +47,9 @@ LOCATION_SLOGANS = {
     "外部": "🌍 世界那麼大，去外面看看吧！"
 }
 
+# --- 試算表欄位 (Sheet1 的 A~J 欄) ---
+BOOKING_COLUMNS = ["日期", "開始時間", "結束時間", "大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態", "編號"]
+
 # --- 心情投票選項 ---
 MOOD_OPTIONS = ["😀 超棒", "😐 平靜", "😫 累累"]
 
@@ -53,6 +68,188 @@ for h in range(8, 18):
 # --- 頁面設定 ---
 st.set_page_config(page_title="行銷部會議預約", page_icon="🧸", layout="wide", initial_sidebar_state="collapsed")
 
+# --- 📊 效能量測 ---
+# 每次重跑 (或單獨重跑的 fragment) 記一筆：各區塊耗時、外部呼叫 (試算表 / SMTP) 的耗時與資料量、快取命中與否。
+# 管理員側邊欄可查看並匯出 JSON Lines；同樣的紀錄也寫到 booking_app.metrics logger
+METRICS_KEEP_RUNS = 500
+METRICS_KEEP_CALLS = 5000
+metrics_log = logging.getLogger("booking_app.metrics")
+
+def _session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "背景"
+
+def _elapsed_ms(started, digits=1):
+    return round((time_module.perf_counter() - started) * 1000, digits)
+
+def _payload_size(value):
+    # 約略的資料量 (字元數)：讀取只算儲存格內容，其他就看 repr 長度
+    if isinstance(value, dict) and "valueRanges" in value:
+        return sum(_payload_size(vr) for vr in value["valueRanges"])
+    if isinstance(value, dict) and "values" in value:
+        return sum(map(len, chain.from_iterable(value["values"])))
+    return 0 if value is None else len(repr(value))
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.active = {}  # session -> 進行中的重跑紀錄
+        self.runs = deque(maxlen=METRICS_KEEP_RUNS)
+        self.calls = deque(maxlen=METRICS_KEEP_CALLS)
+
+    def begin_run(self, label="整頁"):
+        session = _session_id()
+        self.end_run(session, interrupted=True)  # 上一次被 st.rerun / st.stop 打斷沒收尾的
+        run = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "session": session[:8],
+            "label": label,
+            "started": time_module.perf_counter(),
+            "sections": {},
+            "calls": [],
+            "cache": [],
+        }
+        with self.lock:
+            self.active[session] = run
+
+    def end_run(self, session=None, interrupted=False):
+        with self.lock:
+            run = self.active.pop(session or _session_id(), None)
+        if run is None:
+            return
+        run.update(total_ms=_elapsed_ms(run.pop("started")), interrupted=interrupted)
+        with self.lock:
+            self.runs.append(run)
+        metrics_log.info(json.dumps(run, ensure_ascii=False))
+
+    def _current(self):
+        return self.active.get(_session_id())
+
+    @contextmanager
+    def section(self, name):
+        # fragment 單獨重跑時沒有整頁紀錄，自己開一筆
+        ctx = get_script_run_ctx()
+        own = bool(ctx and ctx.fragment_ids_this_run) and self._current() is None
+        if own:
+            self.begin_run(name)
+        started = time_module.perf_counter()
+        try:
+            yield
+        finally:
+            run = self._current()
+            if run is not None:
+                sections = run["sections"]
+                sections[name] = round(sections.get(name, 0) + _elapsed_ms(started), 1)
+            if own:
+                self.end_run()
+
+    def record_call(self, kind, name, started, size=0, error=None):
+        call = {
+            "time": time_module.time(),
+            "kind": kind,
+            "name": name,
+            "ms": _elapsed_ms(started),
+            "bytes": size,
+            "error": error,
+        }
+        with self.lock:
+            self.calls.append(call)
+            run = self._current()
+            if run is not None:
+                run["calls"].append(call)
+
+    def record_cache(self, name, hit, started):
+        run = self._current()
+        if run is not None:
+            run["cache"].append({"name": name, "hit": hit, "ms": _elapsed_ms(started, 2)})
+
+    def recent_runs(self):
+        with self.lock:
+            return list(self.runs)
+
+    def calls_since(self, since, kind):
+        with self.lock:
+            return sum(1 for c in self.calls if c["time"] >= since and c["kind"] == kind)
+
+    def export_jsonl(self):
+        return "\n".join(json.dumps(run, ensure_ascii=False) for run in self.recent_runs())
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    return Metrics()
+
+def measure_section(name):
+    return get_metrics().section(name)
+
+def measured(name):
+    # 放在 @st.fragment 下面：整頁重跑時算成一個區塊，fragment 單獨重跑時自成一筆
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with measure_section(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def tracked_cache(name, cache):
+    # 包住 st.cache_data / st.cache_resource：函式本體有跑就是沒命中
+    def decorate(fn):
+        @functools.wraps(fn)
+        def compute(*args, **kwargs):
+            get_metrics().local.missed = True
+            return fn(*args, **kwargs)
+        cached = cache(compute)
+
+        @functools.wraps(fn)
+        def lookup(*args, **kwargs):
+            metrics = get_metrics()
+            outer = getattr(metrics.local, "missed", False)
+            metrics.local.missed = False
+            started = time_module.perf_counter()
+            try:
+                return cached(*args, **kwargs)
+            finally:
+                metrics.record_cache(name, not metrics.local.missed, started)
+                metrics.local.missed = outer
+        lookup.clear = cached.clear
+        return lookup
+    return decorate
+
+def metrics_panel():
+    # 管理員側邊欄：最近的重跑耗時、各區塊、外部呼叫與快取命中率
+    metrics = get_metrics()
+    runs = metrics.recent_runs()
+    with st.sidebar.expander("📊 效能統計"):
+        if not runs:
+            return st.caption("還沒有紀錄")
+        pages = [r["total_ms"] for r in runs if r["label"] == "整頁"] or [r["total_ms"] for r in runs]
+        p50, p99 = np.percentile(pages, [50, 99])
+        st.caption(f"整頁重跑 {len(pages)} 次：p50 {p50:.0f} ms / p99 {p99:.0f} ms")
+        recent = metrics.calls_since(time_module.time() - 60, "試算表")
+        st.caption(f"🚦 試算表請求：最近一分鐘 {recent} / {SHEETS_QUOTA_PER_MINUTE}")
+
+        sections = pd.DataFrame([{"區塊": k, "ms": v} for r in runs for k, v in r["sections"].items()])
+        if not sections.empty:
+            summary = sections.groupby("區塊")["ms"].describe(percentiles=[.5, .99])[["count", "50%", "99%"]]
+            st.dataframe(summary.sort_values("99%", ascending=False).round(1), use_container_width=True)
+
+        calls = pd.DataFrame([c for r in runs for c in r["calls"]])
+        if not calls.empty:
+            st.caption(f"每次重跑平均外部呼叫 {len(calls) / len(runs):.2f} 次")
+            summary = calls.groupby(["kind", "name"]).agg(
+                次數=("ms", "size"), 平均ms=("ms", "mean"), 資料量=("bytes", "sum"), 失敗=("error", "count"))
+            st.dataframe(summary.round(1), use_container_width=True)
+
+        cache = pd.DataFrame([c for r in runs for c in r["cache"]])
+        if not cache.empty:
+            summary = cache.groupby("name").agg(查詢=("hit", "size"), 命中率=("hit", "mean"), 平均ms=("ms", "mean"))
+            st.dataframe(summary.round(3), use_container_width=True)
+        st.download_button("⬇️ 匯出紀錄 (JSON Lines)", metrics.export_jsonl(),
+                           file_name="metrics.jsonl", mime="application/jsonl")
+
+get_metrics().begin_run()
+
 # --- 😂 每日笑話資料庫 (更新版) ---
 JOKES_DB = [
 
@@ -69,204 +266,1185 @@ JOKES_DB = [
     
 ]
 
-# --- 樣式與 Logo ---
-logo_file = None
-for ext in ["png", "jpg", "jpeg"]:
-    if os.path.exists(f"logo.{ext}"):
-        logo_file = f"logo.{ext}"
-        break
-    elif os.path.exists(f"logo_大頭貼.{ext}"):
-        logo_file = f"logo_大頭貼.{ext}"
-        break
-
-if logo_file:
+# --- 🖼️ 圖片素材 ---
+@tracked_cache("圖片素材", st.cache_resource(show_spinner=False))
+def load_asset(candidates, max_width):
+    # 每個行程只找檔、解碼一次，並縮到顯示尺寸 (約兩倍寬給高解析螢幕)，之後每次重跑直接送快取的 bytes
+    path = next((f for f in candidates if os.path.exists(f)), None)
+    if path is None:
+        return None
     try:
-        logo = Image.open(logo_file)
+        from PIL import Image
+        img = Image.open(path)
+        fmt = "PNG" if img.format == "PNG" else "JPEG"
+        if img.width > max_width:
+            img.thumbnail((max_width, max_width * img.height // img.width), Image.LANCZOS)
+        if fmt == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, optimize=True, **({"quality": 85} if fmt == "JPEG" else {}))
+        return buf.getvalue()
+    except Exception:
+        return None  # 沒裝 Pillow 或圖檔壞掉就不顯示
+
+LOGO_FILES = tuple(f"{name}.{ext}" for ext in ["png", "jpg", "jpeg"] for name in ["logo", "logo_大頭貼"])
+TEAM_PHOTO_FILES = ("team_photo.jpg", "team_photo.png", "team_photo.jpeg", "Gemini_Generated_Image_1ammmg1ammmg1amm.jpg")
+THANK_YOU_FILES = ("thank_you.jpg", "thank_you.jpeg", "thank_you.png")
+
+# --- 樣式與 Logo ---
+with measure_section("頁首"):
+    logo = load_asset(LOGO_FILES, 200)
+    if logo:
         col_logo, col_title = st.columns([1, 5])
         with col_logo: st.image(logo, width=100)
         with col_title: st.title("🧸 行銷部會議預約")
-    except:
+    else:
         st.title("🧸 行銷部會議預約")
-else:
-    st.title("🧸 行銷部會議預約")
 
-# --- 📸 部門合照 ---
-team_photo_file = None
-possible_filenames = ["team_photo.jpg", "team_photo.png", "team_photo.jpeg", "Gemini_Generated_Image_1ammmg1ammmg1amm.jpg"]
-for filename in possible_filenames:
-    if os.path.exists(filename):
-        team_photo_file = filename
-        break
-
-if team_photo_file:
-    try:
-        team_photo = Image.open(team_photo_file) 
+    # --- 📸 部門合照 ---
+    team_photo = load_asset(TEAM_PHOTO_FILES, 1600)
+    if team_photo:
         st.image(team_photo, use_container_width=True, caption="Marketing Team ✨")
-    except: pass
+
+# --- 🚦 試算表請求排程 ---
+# 所有 Google Sheets API 呼叫都經過這裡：令牌桶控制每分鐘用量，429 / 5xx 以指數退避加隨機抖動重試，
+# 多個 session 同時發出的相同讀取只送一次。最後還是失敗就拋出，由呼叫端顯示錯誤，不回傳空資料
+SHEETS_QUOTA_PER_MINUTE = 60   # 每個服務帳號每分鐘的請求額度
+SHEETS_BURST = 10              # 令牌桶容量：閒置一陣子後最多能連發幾個請求
+SHEETS_MAX_RETRIES = 5
+SHEETS_BACKOFF_BASE = 1.0      # 秒，第 n 次重試前等 base * 2^n (加抖動)
+SHEETS_BACKOFF_CAP = 32.0
+SHEETS_MAX_WAIT = 60           # 秒：一個請求最多排隊 + 重試這麼久
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def _http_status(error):
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+class SheetsScheduler:
+    def __init__(self, per_minute=SHEETS_QUOTA_PER_MINUTE, burst=SHEETS_BURST):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time_module.monotonic()
+        self.paused_until = 0.0  # 收到 429 之後整個行程一起暫停，不是每個 session 各自重試
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def _acquire(self, deadline):
+        while True:
+            with self.lock:
+                now = time_module.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                if wait <= 0:
+                    self.tokens -= 1
+                    return
+            if now + wait > deadline:
+                raise RuntimeError("試算表請求額度已用完，請稍後再試")
+            time_module.sleep(wait)
+
+    def _pause(self, delay):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time_module.monotonic() + delay)
+            self.tokens = 0.0
+
+    def _run(self, fn, args, kwargs, write):
+        # 寫入只在 429 時重試：請求確定沒被執行，重送不會重複新增
+        name = getattr(fn, "__name__", "?")
+        deadline = time_module.monotonic() + SHEETS_MAX_WAIT
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self._acquire(deadline)
+            started = time_module.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                get_metrics().record_call("試算表", name, started, _payload_size(args if write else result))
+                return result
+            except Exception as e:
+                status = _http_status(e)
+                get_metrics().record_call("試算表", name, started, error=status or type(e).__name__)
+                transient = status in RETRYABLE_STATUS or isinstance(e, OSError)
+                retry = status == 429 or (not write and transient)
+                if not retry or attempt == SHEETS_MAX_RETRIES:
+                    raise
+                backoff = min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt)
+                delay = backoff / 2 + random.uniform(0, backoff / 2)
+                if time_module.monotonic() + delay > deadline:
+                    raise
+                if status == 429:
+                    self._pause(delay)
+                else:
+                    time_module.sleep(delay)
+
+    def read(self, fn, *args, **kwargs):
+        # 相同的讀取 (同一個物件、同一個方法、同樣的參數) 正在進行中就等它的結果
+        key = (id(getattr(fn, "__self__", fn)), getattr(fn, "__name__", ""), repr(args), repr(sorted(kwargs.items())))
+        with self.lock:
+            pending = self.in_flight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.in_flight[key] = {"done": threading.Event()}
+        if not owner:
+            pending["done"].wait()
+            if "error" in pending:
+                raise pending["error"]
+            return pending["result"]
+        try:
+            pending["result"] = self._run(fn, args, kwargs, write=False)
+            return pending["result"]
+        except Exception as e:
+            pending["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            pending["done"].set()
+
+    def write(self, fn, *args, **kwargs):
+        return self._run(fn, args, kwargs, write=True)
+
+@st.cache_resource(show_spinner=False)
+def get_sheets_scheduler():
+    return SheetsScheduler()
+
+def sheets_read(fn, *args, **kwargs):
+    return get_sheets_scheduler().read(fn, *args, **kwargs)
+
+def sheets_write(fn, *args, **kwargs):
+    return get_sheets_scheduler().write(fn, *args, **kwargs)
 
 # --- 連線函數 ---
-def get_gc():
+def _service_account_info():
+    if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
+        return st.secrets["connections"]["gsheets"]["service_account"]
+    return st.secrets["service_account"]
+
+@st.cache_resource(show_spinner=False)
+def _sheets_connection():
+    # 整個行程共用：一個已驗證的 client、一個試算表 handle、解析過的工作表 handle
+    # 失敗時直接拋出，cache_resource 不會快取例外，下次呼叫會重試
+    import gspread
+    gc = gspread.service_account_from_dict(dict(_service_account_info()))
+    sh = sheets_read(gc.open_by_url, SHEET_URL)
+    worksheets = {ws.title: ws for ws in sheets_read(sh.worksheets)}
+    return {"gc": gc, "sh": sh, "worksheets": worksheets, "lock": threading.RLock()}
+
+@st.cache_resource(show_spinner=False)
+def _connection_status():
+    return {"error": None}  # 最近一次連線失敗的原因，成功後清掉
+
+def connection_error():
+    return _connection_status()["error"]
+
+def get_connection():
+    status = _connection_status()
     try:
-        if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
-            creds = st.secrets["connections"]["gsheets"]["service_account"]
-        else:
-            creds = st.secrets["service_account"]
-        return gspread.service_account_from_dict(creds)
-    except: return None
+        conn = _sheets_connection()
+    except Exception as e:
+        status["error"] = str(e) or type(e).__name__
+        return None
+    creds = getattr(getattr(conn["gc"], "http_client", None), "auth", None)
+    if creds is not None and not creds.valid:
+        # token 過期：在共用鎖內刷新一次；刷新失敗就丟掉舊連線重建
+        with conn["lock"]:
+            try:
+                if not creds.valid:
+                    from google.auth.transport.requests import Request as GoogleAuthRequest
+                    creds.refresh(GoogleAuthRequest())
+            except Exception as e:
+                status["error"] = f"憑證更新失敗: {e}"
+                _sheets_connection.clear()
+                try:
+                    conn = _sheets_connection()
+                except Exception as e:
+                    status["error"] = str(e) or type(e).__name__
+                    return None
+    status["error"] = None
+    return conn
 
-def get_worksheet():
-    gc = get_gc()
-    if gc:
+def open_worksheet(title, rows=100, cols=1, init_values=None):
+    # 工作表 handle 只解析一次；不存在時建立並寫入初始內容
+    conn = get_connection()
+    if not conn:
+        return None
+    ws = conn["worksheets"].get(title)
+    if ws:
+        return ws
+    with conn["lock"]:
+        ws = conn["worksheets"].get(title)
+        if ws:
+            return ws
         try:
-            sh = gc.open_by_url(SHEET_URL)
-            return sh.worksheet("Sheet1")
-        except: return None
-    return None
+            ws = sheets_write(conn["sh"].add_worksheet, title=title, rows=rows, cols=cols)
+            if init_values:
+                sheets_write(ws.update, 'A1', init_values)
+        except Exception:
+            # 可能別的行程剛建立好，改用現有的
+            try:
+                ws = sheets_read(conn["sh"].worksheet, title)
+            except Exception as e:
+                _connection_status()["error"] = f"無法開啟工作表 {title}: {e}"
+                return None
+        conn["worksheets"][title] = ws
+        return ws
+
+def get_worksheet():
+    return open_worksheet("Sheet1")
+
+# --- 🔖 寫入工具與版本標記 ---
+# Meta!B1:B4 各放一個亂數 token，每次寫入就換掉對應的 token；讀取端只要比對這幾格就知道資料有沒有變
+REVISION_ROWS = {"bookings": 1, "jokes": 2, "moods": 3, "archive": 4}
+
+def get_meta_worksheet():
+    return open_worksheet("Meta", rows=10, cols=2, init_values=[[part, ""] for part in REVISION_ROWS])
+
+def _cell_value(value):
+    return {"userEnteredValue": {"stringValue": "" if pd.isna(value) else str(value)}}
+
+def _row_range(ws, row_num, col_start=0, col_end=len(BOOKING_COLUMNS)):
+    return {
+        "sheetId": ws.id,
+        "startRowIndex": row_num - 1,
+        "endRowIndex": row_num,
+        "startColumnIndex": col_start,
+        "endColumnIndex": col_end,
+    }
+
+def update_cells_request(ws, row_num, col_start, values):
+    cells = {"values": [_cell_value(v) for v in values]}
+    cell_range = _row_range(ws, row_num, col_start, col_start + len(values))
+    return {"updateCells": {"range": cell_range, "rows": [cells], "fields": "userEnteredValue"}}
+
+def append_cells_request(ws, rows):
+    cells = [{"values": [_cell_value(v) for v in row]} for row in rows]
+    return {"appendCells": {"sheetId": ws.id, "rows": cells, "fields": "userEnteredValue"}}
+
+def write_batch(ws, requests, meta_ws, parts):
+    # 資料變更與版本 token 放在同一個 batchUpdate 送出；回傳 {part: 新 token}
+    tokens = {part: uuid.uuid4().hex[:12] for part in parts}
+    bumps = [update_cells_request(meta_ws, REVISION_ROWS[part], 0, [part, token]) for part, token in tokens.items()]
+    sheets_write(ws.spreadsheet.batch_update, {"requests": list(requests) + bumps})
+    return tokens
 
 # --- 🔥 笑話管理函數 ---
 def get_jokes_worksheet():
-    gc = get_gc()
-    if gc:
-        try:
-            sh = gc.open_by_url(SHEET_URL)
-            try:
-                ws = sh.worksheet("Jokes")
-            except:
-                ws = sh.add_worksheet(title="Jokes", rows=100, cols=1)
-                ws.update('A1', [['Joke Content']])
-            return ws
-        except: return None
-    return None
-
-def get_all_jokes():
-    # 讀取內建笑話
-    all_jokes = JOKES_DB.copy()
-    # 嘗試讀取自訂笑話
-    try:
-        ws = get_jokes_worksheet()
-        if ws:
-            custom_jokes = ws.col_values(1)
-            if len(custom_jokes) > 1: # 排除標題
-                all_jokes.extend(custom_jokes[1:])
-    except: pass
-    return all_jokes
+    return open_worksheet("Jokes", rows=100, cols=1, init_values=[['Joke Content']])
 
 def add_new_joke(joke_text):
-    ws = get_jokes_worksheet()
-    if ws:
+    backend = get_backend()
+    if not backend.available():
+        return False
+    cache = get_snapshot_cache()
+    with cache.write_lock:
         try:
-            ws.append_row([joke_text])
-            return True
-        except: return False
-    return False
+            token = backend.append_jokes([joke_text])
+        except Exception:
+            return False  # 呼叫端會提示投稿失敗
+        with cache.lock:
+            cache.apply_jokes([joke_text], token)
+    return True
+
+def pick_joke(day, jokes):
+    # 以一年中的第幾天挑笑話；直接算索引，不必組合整份清單
+    total = len(JOKES_DB) + len(jokes)
+    if not total:
+        return "今天沒有笑話..."
+    joke_index = date.fromisoformat(day).timetuple().tm_yday % total
+    return JOKES_DB[joke_index] if joke_index < len(JOKES_DB) else jokes[joke_index - len(JOKES_DB)]
+
+@tracked_cache("每日笑話", st.cache_data(max_entries=2, show_spinner=False))
+def _joke_of_the_day(day, _jokes):
+    # 每天只挑一次 (以日期為 key)，當天有人投稿也不會讓橫幅換掉
+    return pick_joke(day, _jokes)
 
-def get_daily_joke():
-    full_db = get_all_jokes()
-    if not full_db: return "今天沒有笑話..."
-    day_of_year = datetime.now().timetuple().tm_yday
-    joke_index = day_of_year % len(full_db)
-    return full_db[joke_index]
+def get_daily_joke(snapshot):
+    day = date.today().isoformat()
+    if snapshot is EMPTY_SNAPSHOT:
+        return pick_joke(day, ())  # 還沒讀到資料就先不記住
+    return _joke_of_the_day(day, snapshot.jokes)
 
 # --- 🔥 心情投票函數 ---
 def get_mood_worksheet():
-    gc = get_gc()
-    if gc:
-        try:
-            sh = gc.open_by_url(SHEET_URL)
+    init_values = [['Mood', 'Count']] + [[m, 0] for m in MOOD_OPTIONS]
+    return open_worksheet("Moods", rows=10, cols=2, init_values=init_values)
+
+def parse_mood_counts(values):
+    mood_dict = {row[0]: int(row[1]) for row in values[1:] if len(row) >= 2 and row[1].isdigit()}
+    for m in MOOD_OPTIONS:
+        if m not in mood_dict:
+            mood_dict[m] = 0
+    return mood_dict
+
+def _link_mood_counts(moods_ws, votes_ws):
+    # 把 Moods 的票數改成「原票數 + COUNTIF(投票紀錄)」，由試算表端彙總；已經是公式的列不動，
+    # 所以每次啟動都能檢查一次，補上之前沒寫成功的連結
+    params = {"valueRenderOption": "FORMULA"}
+    resp = sheets_read(moods_ws.spreadsheet.values_get, f"'{moods_ws.title}'!A2:B", params=params)
+    cells = {row[0]: str(row[1]) for row in resp.get("values", []) if len(row) >= 2}
+    rows = []
+    for m in MOOD_OPTIONS:
+        value = cells.get(m, "0")
+        if not value.startswith("="):
+            count = int(value) if value.isdigit() else 0
+            value = f"={count}+COUNTIF('{votes_ws.title}'!B:B,\"{m}\")"
+        rows.append([m, value])
+    if any(cells.get(m) != value for m, value in rows):
+        sheets_write(moods_ws.update, f'A2:B{len(rows) + 1}', rows, value_input_option="USER_ENTERED")
+
+def get_mood_votes_worksheet():
+    return open_worksheet("MoodVotes", rows=1000, cols=2, init_values=[['Time', 'Mood']])
+
+MOOD_FLUSH_INTERVAL = 3   # 秒
+MOOD_FLUSH_BATCH = 20     # 累積這麼多票就立刻寫入
+MOOD_FLUSHED_KEEP = 300   # 秒：寫入過的票留著多久，給還沒重讀的快照補上
+
+class MoodVoteLog:
+    # 投票只追加事件：先進記憶體緩衝，由背景執行緒批次追加，寫入失敗的票會留著下次再送
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.in_flight = []
+        self.flushed = []  # (寫入時間, 寫入後的 token, 心情)
+        self.backend = None
+        self.wakeup = threading.Event()
+        threading.Thread(target=self._run, daemon=True, name="mood-vote-flusher").start()
+        atexit.register(self.flush)
+
+    def record(self, mood, backend):
+        with self.lock:
+            self.backend = backend
+            self.pending.append([datetime.now().strftime("%Y-%m-%d %H:%M:%S"), mood])
+            if len(self.pending) >= MOOD_FLUSH_BATCH:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending or self.backend is None:
+                    return
+                self.in_flight, self.pending = self.pending, []
             try:
-                ws = sh.worksheet("Moods")
-            except:
-                ws = sh.add_worksheet(title="Moods", rows=10, cols=2)
-                ws.update('A1:B1', [['Mood', 'Count']])
-                init_data = [[m, 0] for m in MOOD_OPTIONS]
-                ws.update('A2:B4', init_data)
-            return ws
-        except: return None
-    return None
+                token = self.backend.append_mood_votes(self.in_flight)
+            except Exception:
+                with self.lock:
+                    self.pending = self.in_flight + self.pending
+                    self.in_flight = []
+                return
+            done = time_module.time()
+            with self.lock:
+                self.flushed = [v for v in self.flushed if done - v[0] < MOOD_FLUSHED_KEEP]
+                self.flushed += [(done, token, mood) for _, mood in self.in_flight]
+                self.in_flight = []
 
-def load_mood_data():
-    ws = get_mood_worksheet()
-    if ws:
+    def _run(self):
+        while True:
+            self.wakeup.wait(MOOD_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+
+    def unseen_counts(self, snapshot):
+        # 快照還沒包含的票：尚未寫入的，加上快照讀完之後才寫入的。
+        # 快照的 token 等於某批寫入回傳的 token，就表示那批 (和更早的) 已經算在彙總票數裡
+        counts = dict.fromkeys(MOOD_OPTIONS, 0)
+        with self.lock:
+            seen = 0
+            for i, (_, token, _) in enumerate(self.flushed):
+                if token == snapshot.moods_token:
+                    seen = i + 1
+            moods = [m for _, m in self.pending + self.in_flight]
+            moods += [m for t, _, m in self.flushed[seen:] if t >= snapshot.loaded_at]
+        for m in moods:
+            counts[m] = counts.get(m, 0) + 1
+        return counts
+
+@st.cache_resource
+def get_mood_vote_log():
+    return MoodVoteLog()
+
+def record_mood_vote(mood):
+    backend = get_backend()
+    if backend.available():
+        get_mood_vote_log().record(mood, backend)
+
+def current_mood_counts(snapshot):
+    # 快照裡的彙總票數 + 本行程還沒反映到快照的票
+    unseen = get_mood_vote_log().unseen_counts(snapshot)
+    return {m: snapshot.moods.get(m, 0) + unseen.get(m, 0) for m in MOOD_OPTIONS}
+
+# --- 🗄️ 儲存後端 ---
+class StorageBackend(ABC):
+    # 所有讀寫都經過這裡。bookings 的 index 是預約編號 (「編號」欄)，
+    # 每次寫入都會換掉對應資料的版本 token (bookings / jokes / moods)
+    name = ""
+
+    def __init__(self):
+        self.snapshot_cache = SnapshotCache(self)
+
+    @abstractmethod
+    def available(self): ...
+
+    def unavailable_reason(self):
+        return None  # available() 為 False 時的原因，給畫面提示用
+
+    @abstractmethod
+    def read_revisions(self): ...  # -> {part: token}
+
+    @abstractmethod
+    def read(self, parts): ...  # -> ({part: token}, {part: 資料})
+
+    @abstractmethod
+    def write_bookings(self, appends, updates, deletes): ...  # 以編號指定列 -> token
+
+    @abstractmethod
+    def append_jokes(self, jokes): ...  # -> token
+
+    @abstractmethod
+    def append_mood_votes(self, rows): ...  # -> token
+
+    @abstractmethod
+    def archive_bookings(self, frame): ...  # 含 day 欄的舊預約移到封存區 -> {part: token}
+
+    @abstractmethod
+    def read_archive(self, first_day, last_day, token): ...  # [first_day, last_day) 的封存預約
+
+def _by_booking_id(df):
+    return df.set_axis(pd.Index(df['編號'].values), axis=0)
+
+class SheetsBackend(StorageBackend):
+    name = "Google 試算表"
+    RANGES = {"bookings": "'Sheet1'", "jokes": "'Jokes'!A:A", "moods": "'Moods'!A:B"}
+    META_RANGE = "'Meta'!A1:B4"
+    ID_RANGE = "'Sheet1'!J:J"  # 編號欄
+    ID_CELL = "'Sheet1'!J{}"
+    ID_CHECK_MAX = 200  # 一次要核對的格數超過這個，直接重讀整欄比較省
+
+    def __init__(self):
+        super().__init__()
+        self.sheets = None
+        self.rows = {}  # 預約編號 -> 試算表列號，讀快照時記下，寫入前核對
+        self.widened = False
+        self.moods_linked = False
+        self.archive = {}  # 年份 -> 已讀進來的封存分區 (依日期排序)
+        self.archive_token = None
+
+    def available(self):
+        # 工作表 handle 在 script 執行緒解析好，背景執行緒 (心情投票) 直接沿用
+        sheets = {
+            "bookings": get_worksheet(),
+            "jokes": get_jokes_worksheet(),
+            "moods": get_mood_worksheet(),
+            "votes": get_mood_votes_worksheet(),
+            "meta": get_meta_worksheet(),
+        }
+        if all(sheets.values()):
+            self.sheets = sheets
+            if not self.moods_linked:
+                try:
+                    _link_mood_counts(sheets["moods"], sheets["votes"])
+                    self.moods_linked = True
+                except Exception:
+                    pass  # 票數照樣記在 MoodVotes，下次再補連結時 COUNTIF 會把它們算進去
+        return self.sheets is not None
+
+    def unavailable_reason(self):
+        return connection_error()
+
+    def read_revisions(self):
+        resp = sheets_read(self.sheets["meta"].spreadsheet.values_get, self.META_RANGE)
+        return parse_revisions(resp.get("values", []))
+
+    def read(self, parts):
+        ranges = [self.META_RANGE] + [self.RANGES[p] for p in parts]
+        resp = sheets_read(self.sheets["meta"].spreadsheet.values_batch_get, ranges)
+        values = [vr.get("values", []) for vr in resp.get("valueRanges", [])]
+        revisions = parse_revisions(values[0])
+        data = dict(zip(parts, values[1:]))
+        if "bookings" in data:
+            data["bookings"], token = self._index_bookings(parse_bookings(data["bookings"]))
+            if token:
+                revisions["bookings"] = token
+        if "jokes" in data:
+            data["jokes"] = parse_jokes(data["jokes"])
+        if "moods" in data:
+            data["moods"] = parse_mood_counts(data["moods"])
+        return revisions, data
+
+    def _index_bookings(self, df):
+        # df 的 index 是列號；沒有編號 (舊資料、手動貼上的重複列) 的先補上並寫回，再把 index 換成編號
+        ids = df['編號'].str.strip()
+        missing = (ids == "") | ids.duplicated()
+        token = None
+        if missing.any():
+            ids = ids.copy()
+            ids[missing] = [new_booking_id() for _ in range(int(missing.sum()))]
+            ws = self.sheets["bookings"]
+            col = BOOKING_COLUMNS.index("編號")
+            requests = []
+            if ws.col_count < len(BOOKING_COLUMNS) and not self.widened:  # 舊表只有 9 欄
+                extra = len(BOOKING_COLUMNS) - ws.col_count
+                requests.append({"appendDimension": {"sheetId": ws.id, "dimension": "COLUMNS", "length": extra}})
+            for row_num, value in [(1, "編號")] + list(zip(df.index[missing], ids[missing])):
+                requests.append(update_cells_request(ws, row_num, col, [value]))
+            token = write_batch(ws, requests, self.sheets["meta"], ["bookings"])["bookings"]
+            self.widened = True
+        self.rows = dict(zip(ids, df.index.tolist()))
+        return _by_booking_id(df.assign(編號=ids)), token
+
+    def _locate_rows(self, booking_ids):
+        # 在試算表上直接排序、插入、刪除列，或其他行程的寫入，都不一定會換掉 token，快取的列號可能已經指到別筆。
+        # 寫入前先用一次 batchGet 核對要動的那幾格編號；有一格對不上才重讀整欄
+        booking_ids = list(dict.fromkeys(booking_ids))
+        if len(booking_ids) <= self.ID_CHECK_MAX and all(k in self.rows for k in booking_ids):
+            ranges = [self.ID_CELL.format(self.rows[k]) for k in booking_ids]
+            resp = sheets_read(self.sheets["bookings"].spreadsheet.values_batch_get, ranges)
+            cells = [(vr.get("values") or [[]])[0] for vr in resp.get("valueRanges", [])]
+            found = [cell[0].strip() if cell else "" for cell in cells]
+            if found == booking_ids:
+                return
+        # 找不到 (或重複出現) 的編號就整批拒絕，不去猜
+        values = sheets_read(self.sheets["bookings"].spreadsheet.values_get, self.ID_RANGE).get("values", [])
+        ids = [row[0].strip() if row else "" for row in values[1:]]
+        counts = Counter(ids)
+        self.rows = {k: row_num for row_num, k in enumerate(ids, start=2) if k and counts[k] == 1}
+        missing = [k for k in booking_ids if k not in self.rows]
+        if missing:
+            raise RuntimeError(f"試算表上找不到預約 {'、'.join(missing[:3])}，可能已被修改或刪除，請重新整理後再試")
+
+    def write_bookings(self, appends, updates, deletes):
+        # 以編號查出列號後一次 batchUpdate：先更新、再刪除、最後新增到表尾
+        ws = self.sheets["bookings"]
+        requests = []
+        if updates or deletes:
+            self._locate_rows(list(updates) + list(deletes))
+        for booking_id, changes in updates.items():
+            for col, value in changes.items():
+                requests.append(update_cells_request(ws, self.rows[booking_id], BOOKING_COLUMNS.index(col), [value]))
+        requests += self._delete_requests(deletes)
+        if appends:
+            rows = [[row.get(col, "") for col in BOOKING_COLUMNS] for row in appends]
+            requests.append(append_cells_request(ws, rows))
+        return write_batch(ws, requests, self.sheets["meta"], ["bookings"])["bookings"]
+
+    def _delete_requests(self, booking_ids):
+        # 列號要先用 _locate_rows 核對；由下往上刪，前面的刪除不會讓後面的列號位移
+        ws = self.sheets["bookings"]
+        requests = []
+        for r in sorted({self.rows[k] for k in booking_ids}, reverse=True):
+            rows = {"sheetId": ws.id, "dimension": "ROWS", "startIndex": r - 1, "endIndex": r}
+            requests.append({"deleteDimension": {"range": rows}})
+        return requests
+
+    def archive_bookings(self, frame):
+        # 依年份附加到「Archive 年份」分區，並從 Sheet1 刪掉；同一個 batchUpdate 送出，要嘛全部成功要嘛都沒動
+        self._locate_rows(list(frame.index))
+        requests = []
+        years = frame["day"].map(lambda d: date.fromordinal(int(d)).year)
+        for year, part in frame.groupby(years):
+            target = open_worksheet(f"Archive {year}", rows=100, cols=len(BOOKING_COLUMNS),
+                                    init_values=[BOOKING_COLUMNS])
+            if target is None:
+                raise RuntimeError(f"無法開啟 Archive {year}")
+            requests.append(append_cells_request(target, part[BOOKING_COLUMNS].values.tolist()))
+        requests += self._delete_requests(frame.index)
+        tokens = write_batch(self.sheets["bookings"], requests, self.sheets["meta"], ["bookings", "archive"])
+        self.archive = {}
+        self.archive_token = tokens["archive"]
+        return tokens
+
+    def read_archive(self, first_day, last_day, token):
+        # 只讀範圍涵蓋到的年份分區，讀過的分區在封存 token 換掉前都不再下載
+        conn = get_connection()
+        if conn is None:
+            return parse_bookings([])
+        if token != self.archive_token:
+            self.archive = {}
+            self.archive_token = token
+            worksheets = sheets_read(conn["sh"].worksheets)
+            with conn["lock"]:
+                conn["worksheets"].update({ws.title: ws for ws in worksheets})
+        years = range(date.fromordinal(first_day).year, date.fromordinal(last_day - 1).year + 1)
+        missing = [y for y in years if y not in self.archive and f"Archive {y}" in conn["worksheets"]]
+        if missing:
+            resp = sheets_read(conn["sh"].values_batch_get, [f"'Archive {y}'" for y in missing])
+            for year, vr in zip(missing, resp.get("valueRanges", [])):
+                df = parse_bookings(vr.get("values", []))
+                df = _by_booking_id(df[~df['編號'].duplicated()])  # 重複封存的只留一筆
+                df = df.assign(day=to_day_ordinals(df['日期']))
+                self.archive[year] = df.sort_values("day", kind="stable")
+        parts = [self.archive[y] for y in years if y in self.archive]
+        if not parts:
+            return parse_bookings([])
+        df = pd.concat(parts)
+        lo, hi = df["day"].searchsorted([first_day, last_day])
+        return df.iloc[lo:hi][BOOKING_COLUMNS]
+
+    def append_jokes(self, jokes):
+        ws = self.sheets["jokes"]
+        requests = [append_cells_request(ws, [[j] for j in jokes])]
+        return write_batch(ws, requests, self.sheets["meta"], ["jokes"])["jokes"]
+
+    def append_mood_votes(self, rows):
+        ws = self.sheets["votes"]
+        return write_batch(ws, [append_cells_request(ws, rows)], self.sheets["meta"], ["moods"])["moods"]
+
+SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "booking.sqlite3")
+SQLITE_COLUMNS = ", ".join(f'"{col}"' for col in BOOKING_COLUMNS)
+
+class SQLiteBackend(StorageBackend):
+    # 本機離線模式 / 測試與效能量測用；每次寫入都在同一個交易裡連同版本 token 一起提交
+    name = "本機 SQLite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bookings (id INTEGER PRIMARY KEY, {columns});
+        CREATE TABLE IF NOT EXISTS jokes (id INTEGER PRIMARY KEY, content TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS mood_votes (id INTEGER PRIMARY KEY, voted_at TEXT, mood TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS mood_votes_mood ON mood_votes (mood);
+        CREATE TABLE IF NOT EXISTS meta (part TEXT PRIMARY KEY, token TEXT);
+        CREATE TABLE IF NOT EXISTS bookings_archive (id INTEGER PRIMARY KEY, {columns}, day INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS bookings_archive_day ON bookings_archive (day);
+        CREATE UNIQUE INDEX IF NOT EXISTS bookings_archive_booking_id ON bookings_archive ("編號");
+    """.format(columns=", ".join(f'"{col}" TEXT NOT NULL DEFAULT \'\'' for col in BOOKING_COLUMNS))
+
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self.local = threading.local()
+        db = self._db()
+        db.executescript(self.SCHEMA)
+        with db:  # 舊檔沒有「編號」欄：補欄位並給每筆一個編號
+            if "編號" not in [row[1] for row in db.execute("PRAGMA table_info(bookings)")]:
+                db.execute('ALTER TABLE bookings ADD COLUMN "編號" TEXT NOT NULL DEFAULT \'\'')
+            db.execute('UPDATE bookings SET "編號" = lower(hex(randomblob(6))) WHERE "編號" = \'\'')
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS bookings_booking_id ON bookings ("編號")')
+
+    def _db(self):
+        # 每個執行緒一條連線
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=10)
+        return db
+
+    def _bump(self, db, part):
+        token = uuid.uuid4().hex[:12]
+        db.execute("INSERT OR REPLACE INTO meta (part, token) VALUES (?, ?)", (part, token))
+        return token
+
+    def available(self):
+        return True
+
+    def read_revisions(self):
+        return dict(self._db().execute("SELECT part, token FROM meta").fetchall())
+
+    def read(self, parts):
+        db = self._db()
+        data = {}
+        with db:
+            # SELECT 不會自動開交易，要明講；整段讀取看到的是同一個版本，離開 with 時結束
+            db.execute("BEGIN")
+            revisions = dict(db.execute("SELECT part, token FROM meta").fetchall())
+            if "bookings" in parts:
+                df = pd.read_sql_query(f"SELECT {SQLITE_COLUMNS} FROM bookings ORDER BY id", db, dtype=str)
+                data["bookings"] = _by_booking_id(df[df['日期'].str.strip().str.len() > 0])
+            if "jokes" in parts:
+                data["jokes"] = tuple(row[0] for row in db.execute("SELECT content FROM jokes ORDER BY id"))
+            if "moods" in parts:
+                counts = dict(db.execute("SELECT mood, COUNT(*) FROM mood_votes GROUP BY mood").fetchall())
+                data["moods"] = {m: counts.get(m, 0) for m in MOOD_OPTIONS}
+        return revisions, data
+
+    def write_bookings(self, appends, updates, deletes):
+        db = self._db()
+        placeholders = ", ".join("?" * len(BOOKING_COLUMNS))
+        with db:
+            for booking_id, changes in updates.items():
+                for col, value in changes.items():
+                    if col not in BOOKING_COLUMNS:
+                        raise KeyError(col)
+                    db.execute(f'UPDATE bookings SET "{col}" = ? WHERE "編號" = ?', (str(value), booking_id))
+            if deletes:
+                db.executemany('DELETE FROM bookings WHERE "編號" = ?', [(k,) for k in set(deletes)])
+            rows = [[str(row.get(col, "")) for col in BOOKING_COLUMNS] for row in appends]
+            db.executemany(f"INSERT INTO bookings ({SQLITE_COLUMNS}) VALUES ({placeholders})", rows)
+            return self._bump(db, "bookings")
+
+    def append_jokes(self, jokes):
+        db = self._db()
+        with db:
+            db.executemany("INSERT INTO jokes (content) VALUES (?)", [(j,) for j in jokes])
+            return self._bump(db, "jokes")
+
+    def append_mood_votes(self, rows):
+        db = self._db()
+        with db:
+            db.executemany("INSERT INTO mood_votes (voted_at, mood) VALUES (?, ?)", [tuple(r) for r in rows])
+            return self._bump(db, "moods")
+
+    def archive_bookings(self, frame):
+        db = self._db()
+        placeholders = ", ".join("?" * (len(BOOKING_COLUMNS) + 1))
+        rows = [row[:-1] + [int(row[-1])] for row in frame[BOOKING_COLUMNS + ["day"]].values.tolist()]
+        with db:
+            db.executemany(f"INSERT OR IGNORE INTO bookings_archive ({SQLITE_COLUMNS}, day)"
+                           f" VALUES ({placeholders})", rows)
+            db.executemany('DELETE FROM bookings WHERE "編號" = ?', [(k,) for k in frame.index])
+            return {part: self._bump(db, part) for part in ("bookings", "archive")}
+
+    def read_archive(self, first_day, last_day, token):
+        query = f"SELECT {SQLITE_COLUMNS} FROM bookings_archive WHERE day >= ? AND day < ? ORDER BY day"
+        df = pd.read_sql_query(query, self._db(), params=(int(first_day), int(last_day)), dtype=str)
+        return _by_booking_id(df)
+
+def _has_google_credentials():
+    try:
+        if "service_account" in st.secrets:
+            return True
+        return "connections" in st.secrets and "gsheets" in st.secrets["connections"]
+    except Exception:
+        return False  # 沒有 secrets 檔
+
+def _storage_settings():
+    try:
+        cfg = dict(st.secrets["storage"]) if "storage" in st.secrets else {}
+    except Exception:
+        cfg = {}
+    return cfg.get("backend", ""), cfg.get("sqlite_path", SQLITE_PATH)
+
+@st.cache_resource(show_spinner=False)
+def _sheets_backend():
+    return SheetsBackend()
+
+@st.cache_resource(show_spinner=False)
+def _sqlite_backend(path):
+    return SQLiteBackend(path)
+
+def get_backend():
+    # secrets 的 [storage] backend = "sheets" / "sqlite"；沒設定時有 Google 憑證就用試算表，否則用本機 SQLite
+    kind, path = _storage_settings()
+    if kind == "sheets" or (kind != "sqlite" and _has_google_credentials()):
+        return _sheets_backend()
+    return _sqlite_backend(path)
+
+# --- 🧱 預約資料表 ---
+# 讀進來時只正規化一次，之後衝突檢查、行事曆、空檔、批次審核、後台與取消都直接用這張表：
+# 日期 -> 日期序數 (int32)、開始/結束 -> 當天第幾分鐘 (int16)、會議地點 / 狀態 -> category，index 為編號。
+# 無法解析的日期或時間記成 -1，整列仍留在表上，後台看得到也改得到
+STATUS_OPTIONS = ["待審核", "核准", "拒絕"]
+TABLE_COLUMNS = ["day", "start", "end", "大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態"]
+TEXT_COLUMNS = ["大名", "與會人", "預約內容", "登記時間"]
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def to_day_ordinals(dates):
+    # '2024/1/5'、'2024-01-05' 皆可，無法解析的回傳 NaN
+    parsed = pd.to_datetime(dates.astype(str).str.strip().str.replace('/', '-'), errors='coerce', format="%Y-%m-%d")
+    return (parsed - pd.Timestamp("1970-01-01")).dt.days + date(1970, 1, 1).toordinal()
+
+def to_minutes(times):
+    # '9:00'、'09:00:00' -> 540，無法解析的回傳 NaN
+    parts = times.astype(str).str.strip().str.split(":", n=2, expand=True)
+    if parts.shape[1] < 2:
+        return pd.Series(np.nan, index=times.index)
+    return pd.to_numeric(parts[0], errors='coerce') * 60 + pd.to_numeric(parts[1], errors='coerce')
+
+def _categories(values, known):
+    # 已知選項排在前面 (編碼固定，LOCATION_OPTIONS 的第 i 個地點編碼就是 i)，表上出現的其他值接在後面
+    values = values.astype(object).fillna("").astype(str)
+    return pd.Categorical(values, categories=known + sorted(set(values.unique()) - set(known)))
+
+def normalize_bookings(df):
+    # 字串的預約列 (BOOKING_COLUMNS，index 為編號) -> 預約表
+    start = to_minutes(df['開始時間'])
+    end = to_minutes(df['結束時間'])
+    return pd.DataFrame({
+        "day": to_day_ordinals(df['日期']).fillna(-1).astype(np.int32),
+        "start": start.where(start.between(0, 24 * 60 - 1), -1).astype(np.int16),
+        "end": end.where(end.between(1, 24 * 60), -1).astype(np.int16),
+        **{col: df[col].fillna("").astype(str) for col in TEXT_COLUMNS},
+        "會議地點": _categories(df['會議地點'], LOCATION_OPTIONS),
+        "狀態": _categories(df['狀態'], STATUS_OPTIONS),
+    }, index=df.index)[TABLE_COLUMNS]
+
+def concat_tables(tables):
+    # 合併後重新整理 category (各表出現的其他值可能不同)
+    table = pd.concat(tables)
+    return table.assign(會議地點=_categories(table['會議地點'], LOCATION_OPTIONS),
+                        狀態=_categories(table['狀態'], STATUS_OPTIONS))
+
+def date_strings(days):
+    valid = days >= 0
+    offsets = pd.to_timedelta(days.where(valid, EPOCH_ORDINAL) - EPOCH_ORDINAL, unit="D")
+    text = (pd.Timestamp("1970-01-01") + offsets).dt.strftime("%Y-%m-%d")
+    return text.where(valid, "")
+
+def clock_strings(minutes):
+    m = minutes.astype(int)
+    return ((m // 60).astype(str).str.zfill(2) + ":" + (m % 60).astype(str).str.zfill(2)).where(m >= 0, "")
+
+def booking_rows(table):
+    # 預約表 -> 儲存端的字串列 (BOOKING_COLUMNS)；寫回、封存、寄信用
+    return pd.DataFrame({
+        "日期": date_strings(table["day"]),
+        "開始時間": (clock_strings(table["start"]) + ":00").where(table["start"] >= 0, ""),
+        "結束時間": (clock_strings(table["end"]) + ":00").where(table["end"] >= 0, ""),
+        **{col: table[col].astype(str) for col in TEXT_COLUMNS + ["會議地點", "狀態"]},
+        "編號": table.index,
+    }, index=table.index)[BOOKING_COLUMNS]
+
+def scheduled(table):
+    # 日期與時間都能解析的列
+    return table[(table["day"] >= 0) & (table["start"] >= 0) & (table["end"] >= 0)]
+
+# --- 📦 共用資料快照 (Sheet1 / Jokes / Moods) ---
+@dataclass(frozen=True)
+class Snapshot:
+    bookings: pd.DataFrame  # 預約表 (見 normalize_bookings)，index 為編號；所有 session 共用，不可直接修改
+    jokes: tuple            # 自訂笑話 (不含內建 JOKES_DB)
+    moods: dict             # 心情 -> 票數
+    version: str            # 預約資料的版本，給下游快取當 key
+    loaded_at: float = 0.0  # 心情票數讀取完成的時間 (time.time())
+    moods_token: str = ""   # 讀到的心情票數對應的版本 token
+
+SNAPSHOT_PARTS = ("bookings", "jokes", "moods")
+REVISION_CHECK_INTERVAL = 5  # 秒：同一行程內多久比對一次版本 token
+SNAPSHOT_MAX_AGE = 300       # 秒：就算 token 沒變也整份重讀，涵蓋直接在試算表上手動修改的情況
+
+def parse_bookings(values):
+    if not values:
+        return pd.DataFrame(columns=BOOKING_COLUMNS)
+    header = values[0][:len(BOOKING_COLUMNS)]
+    width = len(header)
+    rows = [(row + [""] * width)[:width] for row in values[1:]]
+    df = pd.DataFrame(rows, columns=header, index=pd.RangeIndex(2, len(rows) + 2), dtype=str)
+    df = df[df['日期'].str.strip().str.len() > 0]
+    if '狀態' not in df.columns: df['狀態'] = '核准'
+    if '會議地點' not in df.columns: df['會議地點'] = ''
+    if '與會人' not in df.columns: df['與會人'] = ''
+    if '編號' not in df.columns: df['編號'] = ''
+    return df
+
+def new_booking_id():
+    return uuid.uuid4().hex[:12]
+
+def parse_jokes(values):
+    return tuple(row[0] for row in values[1:] if row and row[0])  # 排除標題
+
+def parse_revisions(values):
+    return {row[0]: (row[1] if len(row) > 1 else "") for row in values if row}
+
+EMPTY_SNAPSHOT = Snapshot(normalize_bookings(parse_bookings([])), (), parse_mood_counts([]), "empty")
+
+class SnapshotCache:
+    # 每個儲存後端共用一份快照：定期比對版本 token，只重讀有變動的部分；
+    # 本行程的寫入直接套用到快照上，不必重新下載。
+    # lock 只保護下面這些狀態，拿著它時不呼叫試算表 (遇到 429 可能要等上一分鐘)：
+    # 重讀由 refresh_lock 排隊、本行程的寫入由 write_lock 排隊、封存區讀取由 archive_lock 排隊
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.archive_lock = threading.Lock()
+        self.snapshot = None
+        self.revisions = {}
+        self.generation = 0  # 本行程每套用一次寫入就加一；重讀期間有變就丟掉讀到的結果
+        self.checked_at = 0.0
+        self.loaded_at = 0.0
+        self.index = None
+        self.index_version = None
+        self.usage = None  # 使用率統計 (含封存)，有建過才跟著更新，見 get_usage_stats
+        self.error = None  # 最近一次讀取失敗的原因；成功後清掉
+        self.failed_at = 0.0
+        self.reads = 0  # 實際下載資料的次數，算快取命中用
+
+    def get(self, check_interval=REVISION_CHECK_INTERVAL):
+        started = time_module.perf_counter()
+        reads = self.reads
+        snapshot = self._get(check_interval)
+        get_metrics().record_cache("預約快照", self.reads == reads, started)
+        return snapshot
+
+    def _fresh(self, check_interval):
+        with self.lock:
+            if self.snapshot is None:
+                return False
+            return time_module.time() - max(self.checked_at, self.failed_at) < check_interval
+
+    def _get(self, check_interval):
+        # 已經有快照時，別人正在重讀就直接用現有的 (畫面會提示資料可能較舊)，不排隊等；
+        # 還沒有快照，或要求立刻確認 (check_interval=0，例如送出前的衝突檢查) 才等
+        if not self._fresh(check_interval):
+            wait = self.snapshot is None or check_interval == 0
+            if self.refresh_lock.acquire(blocking=wait):
+                try:
+                    if not self._fresh(check_interval):
+                        self._refresh()
+                finally:
+                    self.refresh_lock.release()
+        return self.snapshot or EMPTY_SNAPSHOT
+
+    def _refresh(self):
+        now = time_module.time()
+        if not self.backend.available():
+            reason = self.backend.unavailable_reason()
+            with self.lock:
+                self.error = f"無法連線到資料來源: {reason}" if reason else "無法連線到資料來源"
+                self.failed_at = now
+            return
+        with self.lock:
+            generation = self.generation
+            known = dict(self.revisions)
+            full = self.snapshot is None or now - self.loaded_at > SNAPSHOT_MAX_AGE
         try:
-            data = ws.get_all_values()
-            mood_dict = {row[0]: int(row[1]) for row in data[1:] if len(row) >= 2 and row[1].isdigit()}
-            for m in MOOD_OPTIONS:
-                if m not in mood_dict: mood_dict[m] = 0
-            return mood_dict
-        except: pass
-    return {m: 0 for m in MOOD_OPTIONS}
-
-def update_mood_count(mood_to_add):
-    ws = get_mood_worksheet()
-    if ws:
+            data = {}
+            if full:
+                parts = list(SNAPSHOT_PARTS)
+            else:
+                revisions = self.backend.read_revisions()
+                parts = [p for p in SNAPSHOT_PARTS if revisions.get(p) != known.get(p)]
+            if parts:
+                revisions, data = self.backend.read(parts)
+            done = time_module.time()
+        except Exception as e:
+            # 讀不到就繼續用舊快照，並記下原因讓畫面提示；不拿空資料冒充
+            with self.lock:
+                self.error = str(e) or type(e).__name__
+                self.failed_at = now
+            return
+        with self.lock:
+            if generation != self.generation:
+                return  # 讀取期間本行程寫入過，讀到的可能比快照舊；下次再比對
+            if data:
+                self._merge(data, revisions, done)
+                self.reads += 1
+            if full:
+                self.loaded_at = now
+            if revisions.get("archive") != self.revisions.get("archive"):
+                self.usage = None  # 別的行程整理過封存區，統計重建
+            self.revisions = revisions
+            self.checked_at = now
+            self.error = None
+
+    def _merge(self, data, revisions, done):
+        snap = self.snapshot or EMPTY_SNAPSHOT
+        changes = {}
+        if "bookings" in data:
+            df = normalize_bookings(data["bookings"])
+            version = f"{len(df)}-{pd.util.hash_pandas_object(df).sum():x}"
+            if version != snap.version:  # 內容沒變就沿用舊的 DataFrame，下游快取繼續命中
+                changes.update(bookings=df, version=version)
+                if self.usage is not None:  # 只動快照這段，不重掃封存
+                    self.usage.add_frame(snap.bookings, -1)
+                    self.usage.add_frame(df)
+        if "jokes" in data:
+            changes["jokes"] = data["jokes"]
+        if "moods" in data:
+            # 用讀取完成的時間：讀取期間才寫入的票，若沒讀到，token 會比那批舊，下次比對就會重讀
+            changes.update(moods=data["moods"], loaded_at=done, moods_token=revisions.get("moods", ""))
+        self.snapshot = replace(snap, **changes)
+
+    def invalidate(self, part):
+        with self.lock:
+            self.revisions.pop(part, None)
+            self.checked_at = 0.0
+            self.generation += 1
+
+    def apply_bookings(self, appends, updates, deletes, token, archived=False):
+        # 呼叫端需持有 self.lock；與寫入的順序一致：更新 -> 刪除 -> 新增，列都以編號指定
+        # archived：刪除的列是搬到封存區，使用率統計不扣
+        snap = self.snapshot
+        if snap is None or "bookings" not in self.revisions:
+            return self.invalidate("bookings")
+        if self.revisions["bookings"] == token:
+            return  # 寫入後、套用前剛好有人重讀，快照已經含這次的寫入
+        self.generation += 1
+        df = snap.bookings
+        usage = self.usage
+        changed = [booking_id for booking_id in updates if booking_id in df.index]
+        if changed:
+            # 改到的列轉回字串、套上修改再正規化，放回原本的位置
+            rows = booking_rows(df.loc[changed])
+            for booking_id in changed:
+                for col, value in updates[booking_id].items():
+                    rows.at[booking_id, col] = str(value)
+            rows = normalize_bookings(rows)
+            if usage is not None:
+                usage.add_frame(df.loc[changed], -1)
+                usage.add_frame(rows)
+            df = concat_tables([df.drop(index=changed), rows]).reindex(df.index)
+        if deletes:
+            deleted = df.index.intersection(list(deletes))
+            if usage is not None and not archived:
+                usage.add_frame(df.loc[deleted], -1)
+            df = df.drop(index=deleted)
+        new_rows = None
+        if appends:
+            rows = pd.DataFrame([{col: str(row.get(col, "")) for col in BOOKING_COLUMNS} for row in appends],
+                                index=[row["編號"] for row in appends])
+            new_rows = normalize_bookings(rows[rows['日期'].str.strip().str.len() > 0])
+            df = concat_tables([df, new_rows])
+            if usage is not None:
+                usage.add_frame(new_rows)
+        version = f"{snap.version}+{token}"
+        appended_only = not updates and not deletes
+        if self.index is not None and self.index_version == snap.version and appended_only:
+            if new_rows is not None:
+                self.index.add_frame(new_rows)
+            self.index_version = version
+        self.snapshot = replace(snap, bookings=df, version=version)
+        self.revisions["bookings"] = token
+
+    def apply_jokes(self, jokes, token):
+        snap = self.snapshot
+        if snap is None or "jokes" not in self.revisions:
+            return self.invalidate("jokes")
+        if self.revisions["jokes"] == token:
+            return
+        self.generation += 1
+        self.snapshot = replace(snap, jokes=snap.jokes + tuple(jokes))
+        self.revisions["jokes"] = token
+
+def get_snapshot_cache():
+    return get_backend().snapshot_cache
+
+def load_snapshot(check_interval=REVISION_CHECK_INTERVAL):
+    return get_snapshot_cache().get(check_interval)
+
+# --- 🗃️ 封存與歷史查詢 ---
+# 快照只放當月起的預約 (表單、衝突檢查、本週行事曆只需要這些)；更早的每天整理一次移到封存區
+def archive_cutoff(today=None):
+    return (today or date.today()).replace(day=1).toordinal()
+
+@st.cache_resource(show_spinner=False)
+def _compaction_state():
+    return {"day": None, "lock": threading.Lock(), "error": None}  # error：今天整理失敗的原因，後台會顯示
+
+def compact_bookings(today=None):
+    # 每個行程每天最多整理一次；失敗就等明天再試，不要每次重跑都打 API
+    today = today or date.today()
+    state = _compaction_state()
+    if state["day"] == today or not state["lock"].acquire(blocking=False):
+        return 0
+    try:
+        state["day"] = today
+        backend = get_backend()
+        if not backend.available():
+            return 0
+        cache = backend.snapshot_cache
+        with cache.write_lock:
+            df = cache.get(check_interval=0).bookings
+            if cache.error:
+                return 0  # 快照不是最新的，列號可能對不上
+            old = ((df["day"] >= 0) & (df["day"] < archive_cutoff(today))).to_numpy()
+            if not old.any():
+                return 0
+            moved = booking_rows(df[old]).assign(day=df["day"][old].astype(int))
+            tokens = backend.archive_bookings(moved)
+            with cache.lock:
+                cache.apply_bookings((), {}, list(moved.index), tokens["bookings"], archived=True)
+                cache.revisions["archive"] = tokens["archive"]
+            state["error"] = None
+            return len(moved)
+    except Exception as e:
+        state["error"] = str(e) or type(e).__name__
+        get_snapshot_cache().invalidate("bookings")
+        return 0
+    finally:
+        state["lock"].release()
+
+def archived_bookings(first_day, last_day):
+    backend = get_backend()
+    if first_day >= last_day or not backend.available():
+        return EMPTY_SNAPSHOT.bookings
+    cache = backend.snapshot_cache
+    with cache.archive_lock:
         try:
-            cell = ws.find(mood_to_add)
-            if cell:
-                current_val = int(ws.cell(cell.row, cell.col + 1).value)
-                ws.update_cell(cell.row, cell.col + 1, current_val + 1)
-        except: pass
+            return normalize_bookings(backend.read_archive(first_day, last_day, cache.revisions.get("archive")))
+        except Exception as e:
+            st.warning(f"封存資料讀取失敗: {e}")
+            return EMPTY_SNAPSHOT.bookings
+
+def load_history(first_day, last_day):
+    # [first_day, last_day) 的所有預約：快照裡的加上封存區裡的
+    snapshot = load_snapshot()
+    frame = _calendar_frame(snapshot.bookings, snapshot.version)
+    lo, hi = frame["day"].searchsorted([first_day, last_day])
+    archived = archived_bookings(first_day, min(last_day, archive_cutoff()))
+    history = concat_tables([frame.iloc[lo:hi], archived])
+    history = history[~history.index.duplicated()]
+    return history.sort_values("day", kind="stable")
+
+def rerun_fragment():
+    # 只有 fragment 自己重跑時才能限定範圍；整頁執行途中就整頁重跑
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 # --- 😂 每日一笑 ---
-st.markdown(f"""
-    <div style="
-        background-color: #FFF3E0; 
-        padding: 15px; 
-        border-radius: 15px; 
-        border: 2px dashed {THEME_COLOR}; 
-        color: {ACCENT_COLOR};
-        margin-bottom: 20px;
-        text-align: center;
-        font-family: 'Comic Sans MS', sans-serif;">
-        ✨ <b>Daily Smile：</b> {get_daily_joke()} ✨
-    </div>
-""", unsafe_allow_html=True)
+@st.fragment
+@measured("笑話")
+def joke_section():
+    snapshot = load_snapshot()
+    st.markdown(f"""
+        <div style="
+            background-color: #FFF3E0; 
+            padding: 15px; 
+            border-radius: 15px; 
+            border: 2px dashed {THEME_COLOR}; 
+            color: {ACCENT_COLOR};
+            margin-bottom: 20px;
+            text-align: center;
+            font-family: 'Comic Sans MS', sans-serif;">
+            ✨ <b>Daily Smile：</b> {get_daily_joke(snapshot)} ✨
+        </div>
+    """, unsafe_allow_html=True)
 
-# --- 🙋 前台：同仁投稿笑話 ---
-with st.expander("🙋 我也想講笑話！(投稿)", expanded=False):
-    new_joke_input = st.text_input("輸入笑話內容", placeholder="範例：為什麼電腦會冷？因為它有 Windows")
-    if st.button("➕ 送出笑話", use_container_width=True):
-        if new_joke_input:
-            if add_new_joke(new_joke_input):
-                st.success("笑話已投稿成功！感謝你的幽默感 💖")
-                st.balloons()
+    # 🙋 前台：同仁投稿笑話 (送出後只重跑這一區，橫幅會跟著換成新的笑話清單)
+    with st.expander("🙋 我也想講笑話！(投稿)", expanded=False):
+        new_joke_input = st.text_input("輸入笑話內容", placeholder="範例：為什麼電腦會冷？因為它有 Windows")
+        if st.button("➕ 送出笑話", use_container_width=True):
+            if new_joke_input:
+                if add_new_joke(new_joke_input):
+                    st.success("笑話已投稿成功！感謝你的幽默感 💖")
+                    st.balloons()
+                else:
+                    st.error("投稿失敗，請檢查連線")
             else:
-                st.error("投稿失敗，請檢查連線")
-        else:
-            st.warning("請輸入內容")
+                st.warning("請輸入內容")
 
-# --- 🌡️ 心情投票區塊 ---
-st.markdown(f"<h3 style='text-align: center; color: {ACCENT_COLOR};'>🌡️ 今天心情如何？</h3>", unsafe_allow_html=True)
-mood_counts = load_mood_data()
-total_votes = sum(mood_counts.values()) if mood_counts else 0
+joke_section()
 
+# --- 🌡️ 心情投票區塊 ---
 if "has_voted" not in st.session_state:
     st.session_state["has_voted"] = False
 
-if not st.session_state["has_voted"]:
-    c1, c2, c3 = st.columns(3)
-    if c1.button("😀 超棒", use_container_width=True):
-        update_mood_count("😀 超棒")
-        st.session_state["has_voted"] = True
-        st.rerun()
-    if c2.button("😐 平靜", use_container_width=True):
-        update_mood_count("😐 平靜")
-        st.session_state["has_voted"] = True
-        st.rerun()
-    if c3.button("😫 累累", use_container_width=True):
-        update_mood_count("😫 累累")
-        st.session_state["has_voted"] = True
-        st.rerun()
-else:
-    st.info("✨ 收到你的心情了！來看看大家的狀態：")
-    for mood in MOOD_OPTIONS:
-        count = mood_counts.get(mood, 0)
-        percent = (count / total_votes) if total_votes > 0 else 0
-        st.write(f"**{mood}** ({count} 票)")
-        st.progress(percent, text=f"{int(percent*100)}%")
-    if st.button("🔄 再投一次 (測試用)", type="secondary"):
-        st.session_state["has_voted"] = False
-        st.rerun()
+def cast_mood_vote(mood):
+    record_mood_vote(mood)
+    st.session_state["has_voted"] = True
+
+@st.fragment
+@measured("心情")
+def mood_panel():
+    st.markdown(f"<h3 style='text-align: center; color: {ACCENT_COLOR};'>🌡️ 今天心情如何？</h3>", unsafe_allow_html=True)
+    mood_counts = current_mood_counts(load_snapshot())
+    total_votes = sum(mood_counts.values()) if mood_counts else 0
+
+    if not st.session_state["has_voted"]:
+        # 用 on_click 在重跑前記票，這一輪就直接畫出結果，不必再 st.rerun
+        c1, c2, c3 = st.columns(3)
+        c1.button("😀 超棒", use_container_width=True, on_click=cast_mood_vote, args=("😀 超棒",))
+        c2.button("😐 平靜", use_container_width=True, on_click=cast_mood_vote, args=("😐 平靜",))
+        c3.button("😫 累累", use_container_width=True, on_click=cast_mood_vote, args=("😫 累累",))
+    else:
+        st.info("✨ 收到你的心情了！來看看大家的狀態：")
+        for mood in MOOD_OPTIONS:
+            count = mood_counts.get(mood, 0)
+            percent = (count / total_votes) if total_votes > 0 else 0
+            st.write(f"**{mood}** ({count} 票)")
+            st.progress(percent, text=f"{int(percent*100)}%")
+        st.button("🔄 再投一次 (測試用)", type="secondary",
+                  on_click=st.session_state.update, kwargs={"has_voted": False})
 
+mood_panel()
 st.markdown("---")
 
 # --- 🎨 CSS 優化 (韓系 Ins 風) ---
@@ -307,20 +1485,296 @@ st.markdown(f"""
     </style>
 """, unsafe_allow_html=True)
 
-def fix_time(t_str):
-    if not t_str: return None
-    t_str = str(t_str).strip()
-    if t_str.count(":") == 1: t_str += ":00"
-    try: return datetime.strptime(t_str, "%H:%M:%S").strftime("%H:%M:%S")
-    except: return None
+# --- 🗓️ 行事曆事件 ---
+# 每個 session 以週為單位保存算好的事件：目前這週當場算，前後 PREFETCH_WEEKS 週交給背景執行緒補齊。
+# 換週時直接從記憶體組出來；送給行事曆的也是整個視窗，前端按上一週 / 下一週時事件已經在畫面上
+PREFETCH_WEEKS = 2  # 目前這週前後各預先準備幾週
+PREFETCH_WORKERS = 2
+STATUS_COLORS = {"待審核": "#F39C12", "拒絕": "#7F8C8D"}
+
+def week_anchor(anchor_iso):
+    # datesSet 的 startStr (或今天) -> 該週週日的日期序數 (FullCalendar 週檢視預設從週日開始)
+    day = date.fromisoformat(anchor_iso[:10])
+    return day.toordinal() - day.isoweekday() % 7
+
+@tracked_cache("行事曆排序", st.cache_resource(max_entries=8, show_spinner=False))
+def _calendar_frame(_df, version):
+    # 每份快照排序一次：只留日期時間有效的列，依日期排序以便二分切出可見範圍
+    return scheduled(_df).sort_values("day", kind="stable")
+
+def calendar_events(frame, is_admin):
+    # 已排序、已切好範圍的預約表 -> FullCalendar 事件；不碰 st.*，背景執行緒也能用
+    if not is_admin:
+        frame = frame[frame['狀態'] == '核准']
+    if frame.empty:
+        return []
+    day_str = date_strings(frame["day"])
+    start_str = clock_strings(frame["start"])
+    end_str = clock_strings(frame["end"])
+    statuses = frame['狀態'].astype(str)
+    locations = frame['會議地點'].astype(str)
+    color = statuses.map(STATUS_COLORS).fillna(THEME_COLOR)
+    title = "[" + locations + "] " + frame['大名']
+    if is_admin:
+        title = "(" + statuses + ") " + title
+    columns = zip(title, day_str, start_str, end_str, color, frame.index, locations,
+                  frame['大名'], frame['與會人'], frame['預約內容'], statuses)
+    return [{
+        "title": t,
+        "start": f"{d}T{s}:00",
+        "end": f"{d}T{e}:00",
+        "backgroundColor": c,
+        "borderColor": c,
+        "textColor": "#FFFFFF",
+        "extendedProps": {
+            "id": booking_id,
+            "location": loc,
+            "name": name,
+            "attendees": attendees,
+            "content": content,
+            "status": status,
+            "pretty_time": f"{s} - {e}",
+        },
+    } for t, d, s, e, c, booking_id, loc, name, attendees, content, status in columns]
+
+def week_events(frames, week, is_admin):
+    # frames: 依日期排序的預約表 (快照、封存)；取 [week, week+7) 的事件
+    events = []
+    for frame in frames:
+        lo, hi = frame["day"].searchsorted([week, week + 7])
+        events += calendar_events(frame.iloc[lo:hi], is_admin)
+    return events
+
+@st.cache_resource(show_spinner=False)
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="calendar-prefetch")
+
+class CalendarWeeks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.weeks = {}
+        self.pending = set()
+
+    def events(self, key, anchor, build):
+        # key：資料版本 + 身分，變了就整份作廢；build(week) -> 該週事件。
+        # 回傳 (視窗內的事件, 目前這週是否已在記憶體)
+        span = range(anchor - 7 * PREFETCH_WEEKS, anchor + 7 * PREFETCH_WEEKS + 1, 7)
+        with self.lock:
+            if key != self.key:
+                self.key = key
+                self.weeks = {}
+                self.pending = set()
+            self.weeks = {week: events for week, events in self.weeks.items() if week in span}  # 只留目前的視窗
+            hit = anchor in self.weeks
+            missing = [week for week in span
+                       if week != anchor and week not in self.weeks and week not in self.pending]
+            self.pending.update(missing)
+        if not hit:
+            self._store(key, anchor, build(anchor))
+        if missing:
+            get_prefetch_pool().submit(self._fill, key, missing, build)
+        with self.lock:
+            events = list(chain.from_iterable(self.weeks[week] for week in span if week in self.weeks))
+        return events, hit
+
+    def _store(self, key, week, events):
+        with self.lock:
+            if key != self.key:
+                return  # 資料已經換版，這份作廢
+            self.pending.discard(week)
+            if events is not None:
+                self.weeks[week] = events
+
+    def _fill(self, key, weeks, build):
+        for week in weeks:
+            try:
+                events = build(week)
+            except Exception:
+                events = None  # 背景算失敗就算了，換到那週時會當場重算
+            self._store(key, week, events)
+
+def session_calendar_weeks():
+    if "calendar_weeks" not in st.session_state:
+        st.session_state["calendar_weeks"] = CalendarWeeks()
+    return st.session_state["calendar_weeks"]
+
+# --- 📮 寄信佇列 ---
+# 信件先寫進本機 SQLite 佇列就回傳，由背景執行緒沿用同一條已登入的 SMTP 連線寄出，失敗會退避重試
+OUTBOX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox.sqlite3")
+MAIL_COALESCE = 2        # 秒：被喚醒後稍等一下，讓同一波的信一起處理
+MAIL_POLL_INTERVAL = 30  # 秒：沒人喚醒時多久檢查一次待重試的信
+MAIL_RETRY_BASE = 5      # 秒：第 n 次失敗後等 base * 2^n (含抖動)
+MAIL_MAX_ATTEMPTS = 6
+MAIL_IDLE_CLOSE = 60     # 秒：閒置超過就關掉 SMTP 連線
+MAIL_CLAIM_TIMEOUT = 300 # 秒：認領後這麼久還沒結果，視為該行程已死，別人可以重新認領
+
+def _email_config():
+    # smtp_host / smtp_port / starttls 可在 secrets 覆寫，例如指向本機的測試 SMTP
+    try:  # 沒有 secrets 檔 (本機 SQLite 模式) 時 st.secrets 會直接丟錯
+        if "email" not in st.secrets:
+            return None
+        cfg = st.secrets["email"]
+    except Exception:
+        return None
+    return {
+        "sender": cfg["sender"],
+        "password": cfg.get("password", ""),
+        "receiver": cfg["receiver"],
+        "host": cfg.get("smtp_host", "smtp.gmail.com"),
+        "port": int(cfg.get("smtp_port", 587)),
+        "starttls": bool(cfg.get("starttls", True)),
+        "digest_threshold": int(cfg.get("digest_threshold", 5)),
+        "outbox_path": cfg.get("outbox_path", OUTBOX_PATH),
+    }
+
+class MailOutbox:
+    def __init__(self, config):
+        self.config = config
+        self.path = config["outbox_path"]
+        self.server = None
+        self.last_used = 0.0
+        self.wakeup = threading.Event()
+        self.worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY, subject TEXT, body TEXT, created REAL,
+                attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0, sent REAL, error TEXT,
+                claimed_by TEXT, claimed_at REAL)""")
+            # 舊版建立的佇列檔沒有認領欄位，補上 (別的行程可能剛好先補了)
+            columns = {row[1] for row in db.execute("PRAGMA table_info(outbox)")}
+            for column, kind in (("claimed_by", "TEXT"), ("claimed_at", "REAL")):
+                if column not in columns:
+                    try:
+                        db.execute(f"ALTER TABLE outbox ADD COLUMN {column} {kind}")
+                    except sqlite3.OperationalError:
+                        pass
+        threading.Thread(target=self._run, daemon=True, name="mail-outbox").start()
+
+    def _db(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def enqueue(self, subject, body):
+        with self._db() as db:
+            db.execute("INSERT INTO outbox (subject, body, created) VALUES (?, ?, ?)",
+                       (subject, body, time_module.time()))
+        self.wakeup.set()
+
+    def failed_count(self):
+        with self._db() as db:
+            query = "SELECT COUNT(*) FROM outbox WHERE sent IS NULL AND attempts >= ?"
+            return db.execute(query, (MAIL_MAX_ATTEMPTS,)).fetchone()[0]
+
+    def _connect(self):
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return self.server
+            except Exception:
+                pass
+            self._close()
+        import smtplib
+        cfg = self.config
+        server = smtplib.SMTP(cfg["host"], cfg["port"], timeout=30)
+        if cfg["starttls"]:
+            server.starttls()
+        if cfg["password"]:
+            server.login(cfg["sender"], cfg["password"])
+        self.server = server
+        return server
+
+    def _close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            pass
+        self.server = None
+
+    def _send(self, subject, body):
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+        cfg = self.config
+        started = time_module.perf_counter()
+        msg = MIMEMultipart()
+        msg['From'] = cfg["sender"]
+        msg['To'] = cfg["receiver"]
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+        try:
+            self._connect().sendmail(cfg["sender"], cfg["receiver"], msg.as_string())
+        except Exception as e:
+            get_metrics().record_call("SMTP", "sendmail", started, len(body), error=type(e).__name__)
+            raise
+        get_metrics().record_call("SMTP", "sendmail", started, len(body))
+        self.last_used = time_module.time()
+
+    def _claim(self):
+        # 先用一個 UPDATE 把到期的信認領下來，再只寄自己認領到的；
+        # 同一個佇列檔有好幾個行程在寄時，同一封信不會被兩邊都寄出
+        now = time_module.time()
+        with self._db() as db:
+            db.execute("UPDATE outbox SET claimed_by = ?, claimed_at = ?"
+                       " WHERE sent IS NULL AND attempts < ? AND next_attempt <= ?"
+                       " AND (claimed_at IS NULL OR claimed_at < ?)",
+                       (self.worker, now, MAIL_MAX_ATTEMPTS, now, now - MAIL_CLAIM_TIMEOUT))
+            return db.execute("SELECT id, subject, body, attempts FROM outbox"
+                              " WHERE claimed_by = ? AND claimed_at = ? AND sent IS NULL ORDER BY id",
+                              (self.worker, now)).fetchall()
+
+    def drain(self):
+        due = self._claim()
+        threshold = self.config["digest_threshold"]
+        # 一波湧入太多封時合併成一封彙整信
+        batches = [due] if threshold and len(due) >= threshold else [[m] for m in due]
+        for batch in batches:
+            if len(batch) == 1:
+                subject, body = batch[0][1], batch[0][2]
+            else:
+                subject = f"【會議通知彙整】共 {len(batch)} 則"
+                body = "<hr>".join(m[2] for m in batch)
+            try:
+                self._send(subject, body)
+                with self._db() as db:
+                    db.executemany("UPDATE outbox SET sent = ?, error = NULL, claimed_by = NULL, claimed_at = NULL"
+                                   " WHERE id = ?", [(time_module.time(), m[0]) for m in batch])
+            except Exception as e:
+                self._close()
+                retries = []
+                for m in batch:
+                    next_attempt = time_module.time() + MAIL_RETRY_BASE * 2 ** m[3] * random.uniform(0.8, 1.2)
+                    retries.append((next_attempt, str(e)[:500], m[0]))
+                with self._db() as db:
+                    db.executemany("UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, error = ?,"
+                                   " claimed_by = NULL, claimed_at = NULL WHERE id = ?", retries)
+
+    def _run(self):
+        while True:
+            if self.wakeup.wait(MAIL_POLL_INTERVAL):
+                time_module.sleep(MAIL_COALESCE)
+            self.wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                pass  # 佇列檔暫時打不開之類的，下一輪再試
+            if self.server is not None and time_module.time() - self.last_used > MAIL_IDLE_CLOSE:
+                self._close()
+
+@st.cache_resource(show_spinner=False)
+def get_mail_outbox(config):
+    return MailOutbox(config)
 
 # --- 寄信函數 ---
-def send_notification_email(booking_data):
-    if "email" not in st.secrets: return
-    sender_email = st.secrets["email"]["sender"]
-    sender_password = st.secrets["email"]["password"]
-    receiver_email = st.secrets["email"]["receiver"]
-    subject = f"【會議預約通知】{booking_data['大名']} 申請了會議"
+def send_notification_email(booking_data, dates=None):
+    # dates: 週期預約的所有日期，整個系列只寄一封
+    config = _email_config()
+    if not config:
+        return
+    if dates and len(dates) > 1:
+        subject = f"【會議預約通知】{booking_data['大名']} 申請了 {len(dates)} 場週期會議"
+        date_text = f"共 {len(dates)} 次：" + "、".join(dates)
+    else:
+        subject = f"【會議預約通知】{booking_data['大名']} 申請了會議"
+        date_text = booking_data['日期']
     
     body = f"""
     <div style="font-family: Arial, sans-serif; padding: 20px; color: #5D4037; background-color: #FDFBF7;">
@@ -329,7 +1783,7 @@ def send_notification_email(booking_data):
         <div style="background-color: #FFFFFF; padding: 20px; border-radius: 15px; border: 2px dashed {THEME_COLOR};">
             <ul style="list-style-type: none; padding: 0;">
                 <li style="margin-bottom: 10px;"><b>👤 預約人：</b> {booking_data['大名']}</li>
-                <li style="margin-bottom: 10px;"><b>📅 日期：</b> {booking_data['日期']}</li>
+                <li style="margin-bottom: 10px;"><b>📅 日期：</b> {date_text}</li>
                 <li style="margin-bottom: 10px;"><b>⏰ 時間：</b> {booking_data['開始時間']} ~ {booking_data['結束時間']}</li>
                 <li style="margin-bottom: 10px;"><b>📍 地點：</b> {booking_data['會議地點']}</li>
                 <li style="margin-bottom: 10px;"><b>📝 內容：</b> {booking_data['預約內容']}</li>
@@ -342,22 +1796,13 @@ def send_notification_email(booking_data):
         </center>
     </div>
     """
-    msg = MIMEMultipart()
-    msg['From'] = sender_email; msg['To'] = receiver_email; msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls(); server.login(sender_email, sender_password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        server.quit()
-        st.toast("📧 通知信已發送！", icon="✅")
-    except: pass
+    get_mail_outbox(config).enqueue(subject, body)
+    st.toast("📧 通知信已排入寄送！", icon="✅")
 
 def send_deletion_email(booking_data):
-    if "email" not in st.secrets: return
-    sender_email = st.secrets["email"]["sender"]
-    sender_password = st.secrets["email"]["password"]
-    receiver_email = st.secrets["email"]["receiver"]
+    config = _email_config()
+    if not config:
+        return
     subject = f"【會議取消通知】{booking_data['大名']} 取消了會議"
     
     body = f"""
@@ -375,67 +1820,473 @@ def send_deletion_email(booking_data):
         </div>
     </div>
     """
-    msg = MIMEMultipart()
-    msg['From'] = sender_email; msg['To'] = receiver_email; msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls(); server.login(sender_email, sender_password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        server.quit()
-        st.toast("📧 取消通知已發送！", icon="✅")
-    except: pass
-
-@st.cache_data(ttl=5)
+    get_mail_outbox(config).enqueue(subject, body)
+    st.toast("📧 取消通知已排入寄送！", icon="✅")
+
 def load_data():
-    ws = get_worksheet()
-    if ws:
-        try:
-            df = get_as_dataframe(ws, usecols=list(range(9)), parse_dates=False, dtype=str)
-            df = df.dropna(how='all'); df = df.fillna("")
-            df = df[df['日期'].str.len() > 0]
-            if '狀態' not in df.columns: df['狀態'] = '核准'
-            if '會議地點' not in df.columns: df['會議地點'] = ''
-            if '與會人' not in df.columns: df['與會人'] = ''
-            return df
-        except: pass
-    return pd.DataFrame(columns=["日期", "開始時間", "結束時間", "大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態"])
-
-def save_data(df):
-    ws = get_worksheet()
-    if ws:
+    # 預約表 (見 normalize_bookings)，index 為編號，供單列更新/刪除使用
+    return load_snapshot().bookings
+
+# --- ✏️ 單列寫入 ---
+def apply_booking_changes(appends=(), updates=None, deletes=()):
+    # appends: [{欄位: 值}]；updates: {編號: {欄位: 值}}；deletes: [編號]，由後端一次送出
+    updates = updates or {}
+    if not appends and not updates and not len(deletes):
+        return True
+    appends = [{**row, "編號": row.get("編號") or new_booking_id()} for row in appends]
+    backend = get_backend()
+    if not backend.available():
+        return False
+    cache = backend.snapshot_cache
+    with cache.write_lock:  # 同一行程的寫入依序送出、依序套用到快照；讀取不必等
         try:
-            cols = ["日期", "開始時間", "結束時間", "大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態"]
-            df = df[cols]
-            ws.clear(); set_with_dataframe(ws, df); load_data.clear()
-        except Exception as e: st.error(f"寫入失敗: {e}")
-
-def check_overlap(df, check_date, start_t, end_t):
-    if df.empty or '日期' not in df.columns: return None
-    check_date_str = check_date.strftime("%Y-%m-%d")
-    df['temp_date'] = df['日期'].astype(str).str.replace('/', '-').str.strip()
-    day_bookings = df[(df['temp_date'] == check_date_str) & (df['狀態'] != '拒絕')]
-    if day_bookings.empty: return None
-    start_str = start_t.strftime("%H:%M:%S"); end_str = end_t.strftime("%H:%M:%S")
-    overlap = day_bookings[(day_bookings['開始時間'] < end_str) & (day_bookings['結束時間'] > start_str)]
-    if not overlap.empty: return overlap.iloc[0]['大名']
-    return None
+            token = backend.write_bookings(appends, updates, list(deletes))
+        except Exception as e:
+            cache.invalidate("bookings")  # 可能是試算表被直接改過，下次重跑重讀
+            st.error(f"寫入失敗: {e}")
+            return False
+        with cache.lock:
+            cache.apply_bookings(appends, updates, deletes, token)
+    return True
+
+def editor_frame(table):
+    # 後台表格：日期、時間直接用日期 / 時間欄位編輯。index 用 RangeIndex，
+    # data_editor 才會把新增的列加進結果 (隱藏的編號 index 沒辦法自動遞增，新增的列會被丟掉)
+    clock = lambda m: None if m < 0 else time(23, 59) if m >= 24 * 60 else time(m // 60, m % 60)
+    return pd.DataFrame({
+        "日期": [date.fromordinal(d) if d > 0 else None for d in table["day"].tolist()],
+        "開始時間": [clock(m) for m in table["start"].tolist()],
+        "結束時間": [clock(m) for m in table["end"].tolist()],
+        **{col: table[col].astype(str) for col in ["大名", "與會人", "會議地點", "預約內容", "登記時間", "狀態"]},
+        "編號": table.index,
+    }, index=table.index)[BOOKING_COLUMNS].reset_index(drop=True)
+
+def _cell_string(value, fmt):
+    if isinstance(value, str):
+        return value
+    if value is None or pd.isna(value):
+        return ""
+    return value.strftime(fmt)
+
+def editor_rows(frame, cols):
+    # 後台表格 -> 與儲存端同格式的字串
+    rows = frame[cols].astype(object).where(frame[cols].notna(), "").astype(str)
+    for col, fmt in (("日期", "%Y-%m-%d"), ("開始時間", "%H:%M:%S"), ("結束時間", "%H:%M:%S")):
+        if col in cols:
+            rows[col] = [_cell_string(v, fmt) for v in frame[col]]
+    return rows
+
+def diff_bookings(base, edited):
+    # base: 開始編輯時的 editor_frame；edited: data_editor 的結果 (含「刪除」欄)
+    # 以「編號」欄對應，編號空白的是表格裡新增的列 -> (新增, 修改, 刪除)
+    cols = [col for col in BOOKING_COLUMNS if col != "編號"]
+    base, edited = _by_booking_id(base), _by_booking_id(edited)
+    flagged = (edited["刪除"] == True).to_numpy()
+    known = edited.index.isin(base.index)
+    kept = edited[known & ~flagged]
+    deletes = list(base.index.difference(kept.index))  # 勾選刪除或在表格裡整列刪掉的
+    after = editor_rows(kept, cols)
+    changed = after.ne(editor_rows(base.loc[kept.index], cols))
+    updates = {}
+    for booking_id in changed.index[changed.any(axis=1).to_numpy()]:
+        updates[booking_id] = {col: after.at[booking_id, col] for col in cols if changed.at[booking_id, col]}
+    added = editor_rows(edited.loc[~known & ~flagged], cols)
+    appends = [row for row in added.to_dict("records") if any(v.strip() for v in row.values())]
+    return appends, updates, deletes
+
+def append_bookings(rows):
+    return apply_booking_changes(appends=rows)
+
+def update_bookings(updates):
+    return apply_booking_changes(updates=updates)
+
+def delete_bookings(booking_ids):
+    return apply_booking_changes(deletes=booking_ids)
+
+# --- 🗂️ 衝突檢查索引 ---
+def time_to_minutes(t):
+    return t.hour * 60 + t.minute
+
+class BookingIndex:
+    # (日期序數, 會議地點) -> 依開始時間排序的區間，reach[i] 為前 i+1 筆結束時間的最大值
+    def __init__(self):
+        self._slots = {}
+
+    @staticmethod
+    def _intervals(df):
+        df = scheduled(df)
+        df = df[df['狀態'] != '拒絕']
+        return pd.DataFrame({
+            "day": df["day"],
+            "room": df['會議地點'].astype(str),
+            "start": df["start"],
+            "end": df["end"],
+            "name": df['大名'],
+        })
+
+    @classmethod
+    def from_frame(cls, df):
+        index = cls()
+        if df.empty:
+            return index
+        frame = cls._intervals(df)
+        if frame.empty:
+            return index
+        frame = frame.sort_values(["day", "room", "start"], kind="stable")
+        frame["reach"] = frame.groupby(["day", "room"], sort=False)["end"].cummax()
+        keys = list(zip(frame["day"].astype(int), frame["room"]))
+        starts = frame["start"].astype(int).tolist()
+        ends = frame["end"].astype(int).tolist()
+        names = frame["name"].tolist()
+        reach = frame["reach"].astype(int).tolist()
+        bounds = [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]]
+        for lo, hi in zip([0] + bounds, bounds + [len(keys)]):
+            index._slots[keys[lo]] = (starts[lo:hi], ends[lo:hi], names[lo:hi], reach[lo:hi])
+        return index
+
+    def add_frame(self, df):
+        for day, room, start, end, name in self._intervals(df).itertuples(index=False):
+            self.add(int(day), room, int(start), int(end), name)
+
+    def add(self, day, room, start, end, name):
+        starts, ends, names, reach = self._slots.setdefault((day, room), ([], [], [], []))
+        pos = bisect_right(starts, start)
+        starts.insert(pos, start)
+        ends.insert(pos, end)
+        names.insert(pos, name)
+        reach.insert(pos, max(end, reach[pos - 1]) if pos else end)
+        for i in range(pos + 1, len(reach)):
+            new_reach = max(reach[i - 1], ends[i])
+            if new_reach == reach[i]:
+                break
+            reach[i] = new_reach
+
+    def find_conflict(self, day, room, start, end):
+        slot = self._slots.get((day, room))
+        if not slot:
+            return None
+        starts, ends, names, reach = slot
+        n = bisect_left(starts, end)  # 開始時間早於 end 的區間
+        if n == 0 or reach[n - 1] <= start:
+            return None
+        return names[bisect_right(reach, start, 0, n)]  # 第一個結束時間晚於 start 的區間
+
+def get_booking_index(snapshot):
+    # 每份快照只建一次；本行程新增的預約會直接加進索引 (見 SnapshotCache.apply_bookings)
+    cache = get_snapshot_cache()
+    with cache.lock:
+        if cache.index is None or cache.index_version != snapshot.version:
+            cache.index = BookingIndex.from_frame(snapshot.bookings)
+            cache.index_version = snapshot.version
+        return cache.index
+
+def check_overlap(snapshot, check_date, start_t, end_t, location):
+    if snapshot.bookings.empty:
+        return None
+    index = get_booking_index(snapshot)
+    return index.find_conflict(check_date.toordinal(), location, time_to_minutes(start_t), time_to_minutes(end_t))
+
+# --- 🧮 空檔矩陣 ---
+SLOT_MINUTES = 30
+DAY_START = time_to_minutes(TIME_OPTIONS[0])
+N_SLOTS = len(TIME_OPTIONS) - 1  # 08:00 起共 18 個半小時格
+SLOT_LABELS = [t.strftime("%H:%M") for t in TIME_OPTIONS[:-1]]
+
+def slot_bounds(frame):
+    # 預約表的開始 / 結束時間 -> 佔用的半小時格 [k_lo, k_hi)，結束時間無條件進位到下一格
+    starts = frame["start"].to_numpy() - DAY_START
+    ends = frame["end"].to_numpy() - DAY_START
+    k_lo = np.clip(starts // SLOT_MINUTES, 0, N_SLOTS).astype(int)
+    k_hi = np.clip(-(-ends // SLOT_MINUTES), 0, N_SLOTS).astype(int)
+    return k_lo, k_hi
+
+def listed_rooms(frame):
+    # category 編碼即 LOCATION_OPTIONS 的位置；清單外的地點為 False
+    rooms = frame['會議地點'].cat.codes.to_numpy()
+    return rooms, (rooms >= 0) & (rooms < len(LOCATION_OPTIONS))
+
+@tracked_cache("空檔矩陣", st.cache_data(max_entries=32, show_spinner=False))
+def availability_grid(_df, version, first_day, n_days=7):
+    # (天, LOCATION_OPTIONS, 半小時格) 的佔用矩陣，True 代表已被預約 (拒絕的不算)；差分陣列一次填完再沿時間累加
+    frame = _calendar_frame(_df, version)
+    lo, hi = frame["day"].searchsorted([first_day, first_day + n_days])
+    frame = frame.iloc[lo:hi]
+    frame = frame[frame['狀態'] != '拒絕']
+    rooms, known = listed_rooms(frame)
+    frame = frame[known]
+    k_lo, k_hi = slot_bounds(frame)
+    cells = (frame["day"].to_numpy() - first_day, rooms[known])
+    diff = np.zeros((n_days, len(LOCATION_OPTIONS), N_SLOTS + 1), dtype=np.int32)
+    np.add.at(diff, cells + (k_lo,), 1)
+    np.add.at(diff, cells + (k_hi,), -1)
+    return np.cumsum(diff, axis=2)[:, :, :N_SLOTS] > 0
+
+def week_start(day):
+    return day - date.fromordinal(day).weekday()
+
+def day_availability(snapshot, day):
+    # 以整週為單位快取，同一週的查詢共用一次計算
+    first = week_start(day)
+    return availability_grid(snapshot.bookings, snapshot.version, first)[day - first]
+
+def suggest_slots(busy, room, start_t, end_t, limit=3):
+    # busy: 某一天的 (地點, 格) 矩陣 -> (同地點最接近的空檔 [(開始, 結束)], 同時段有空的其他地點)
+    k = (time_to_minutes(start_t) - DAY_START) // SLOT_MINUTES
+    n = -(-(time_to_minutes(end_t) - time_to_minutes(start_t)) // SLOT_MINUTES)
+    if n <= 0 or n > N_SLOTS or room not in LOCATION_OPTIONS:
+        return [], []
+    free = np.concatenate([np.zeros((busy.shape[0], 1), dtype=int), np.cumsum(~busy, axis=1)], axis=1)
+    fits = (free[:, n:] - free[:, :-n]) == n  # fits[r, s]：地點 r 從第 s 格開始連續 n 格都空著
+    r = LOCATION_OPTIONS.index(room)
+    starts = np.flatnonzero(fits[r])
+    starts = np.sort(starts[np.argsort(np.abs(starts - k), kind="stable")][:limit])
+    times = [(TIME_OPTIONS[s], TIME_OPTIONS[s + n]) for s in starts]
+    rooms = []
+    if 0 <= k < fits.shape[1]:
+        rooms = [LOCATION_OPTIONS[i] for i in np.flatnonzero(fits[:, k]) if i != r][:limit]
+    return times, rooms
+
+def availability_table(busy):
+    return pd.DataFrame(np.where(busy, "⛔", ""), index=LOCATION_OPTIONS, columns=SLOT_LABELS)
+
+# --- 📈 使用率統計 ---
+# 含封存區的累計計數，只在第一次打開後台分析時整個掃一次；之後每次寫入由 SnapshotCache 對改到的列加減
+LEAD_TIME_EDGES = np.array([0, 1, 2, 4, 8, 15, 29])
+LEAD_TIME_LABELS = ["當天", "1 天", "2-3 天", "4-7 天", "1-2 週", "2-4 週", "4 週以上"]
+WEEKDAY_LABELS = ["週一", "週二", "週三", "週四", "週五", "週六", "週日"]
+
+class UsageStats:
+    # slots[狀態, 地點, 星期, 半小時格]：佔用該格的預約數
+    # counts[狀態, 地點 (最後一欄是清單外的地點)]：筆數
+    # lead[狀態, 提前天數區間]：筆數，lead_days[狀態]：提前天數總和
+    # 狀態、地點的順序同 STATUS_OPTIONS、LOCATION_OPTIONS
+    def __init__(self):
+        n_status, n_rooms = len(STATUS_OPTIONS), len(LOCATION_OPTIONS)
+        self.slots = np.zeros((n_status, n_rooms, 7, N_SLOTS), dtype=np.int64)
+        self.counts = np.zeros((n_status, n_rooms + 1), dtype=np.int64)
+        self.lead = np.zeros((n_status, len(LEAD_TIME_EDGES)), dtype=np.int64)
+        self.lead_days = np.zeros(n_status, dtype=np.int64)
+        self.first_day = None  # 出現過的日期範圍，算每個星期幾有幾天
+        self.last_day = None
+
+    def add_frame(self, df, sign=1):
+        # sign=-1 扣回去 (刪除的列、修改前的列)；日期時間無效或狀態不在清單內的不算
+        df = scheduled(df)
+        status = df['狀態'].cat.codes.to_numpy()
+        known = (status >= 0) & (status < len(STATUS_OPTIONS))
+        df = df[known]
+        status = status[known]
+        if df.empty:
+            return
+        days = df["day"].to_numpy().astype(np.int64)
+        if sign > 0:
+            self.first_day = min(days.min(), self.first_day or days.min())
+            self.last_day = max(days.max(), self.last_day or days.max())
+        rooms, listed = listed_rooms(df)
+        np.add.at(self.counts, (status, np.where(listed, rooms, len(LOCATION_OPTIONS))), sign)
+
+        # 差分陣列同 availability_grid，星期幾用序數推 (序數 1 是星期一)
+        k_lo, k_hi = slot_bounds(df[listed])
+        cells = (status[listed], rooms[listed], (days[listed] - 1) % 7)
+        diff = np.zeros(self.slots.shape[:-1] + (N_SLOTS + 1,), dtype=np.int64)
+        np.add.at(diff, cells + (k_lo,), sign)
+        np.add.at(diff, cells + (k_hi,), -sign)
+        self.slots += np.cumsum(diff, axis=3)[..., :N_SLOTS]
+
+        # 提前天數：預約日 - 登記日；登記時間缺漏或事後補登 (負數) 的不算
+        lead = days - to_day_ordinals(df['登記時間'].str[:10]).to_numpy()
+        ok = ~np.isnan(lead) & (lead >= 0)
+        lead = lead[ok].astype(np.int64)
+        buckets = np.searchsorted(LEAD_TIME_EDGES, lead, side="right") - 1
+        np.add.at(self.lead, (status[ok], buckets), sign)
+        np.add.at(self.lead_days, status[ok], sign * lead)
+
+    def weekday_counts(self):
+        # 出現過的日期範圍內，每個星期幾各有幾天
+        if self.first_day is None:
+            return np.zeros(7, dtype=np.int64)
+        return np.bincount((np.arange(self.first_day, self.last_day + 1) - 1) % 7, minlength=7)
+
+    def utilization(self, statuses, room=None):
+        # (星期, 半小時格) 的平均佔用率；room=None 為所有地點平均
+        slots = self.slots[[STATUS_OPTIONS.index(s) for s in statuses]].sum(axis=0)
+        slots = slots.mean(axis=0) if room is None else slots[LOCATION_OPTIONS.index(room)]
+        days = np.maximum(self.weekday_counts(), 1)
+        return pd.DataFrame(slots / days[:, None], index=WEEKDAY_LABELS, columns=SLOT_LABELS)
+
+    def room_utilization(self, statuses):
+        # (地點, 星期) 的平均佔用率 (一天 N_SLOTS 格)
+        slots = self.slots[[STATUS_OPTIONS.index(s) for s in statuses]].sum(axis=0).sum(axis=2)
+        capacity = np.maximum(self.weekday_counts(), 1) * N_SLOTS
+        return pd.DataFrame(slots / capacity, index=LOCATION_OPTIONS, columns=WEEKDAY_LABELS)
+
+    def status_table(self):
+        # 每個地點各狀態的筆數與核准率 (核准 / 已審核)
+        table = pd.DataFrame(self.counts.T, index=LOCATION_OPTIONS + ["其他"], columns=STATUS_OPTIONS)
+        table.loc["全部"] = table.sum()
+        decided = table["核准"] + table["拒絕"]
+        decided = decided.where(decided > 0)
+        return table.assign(核准率=table["核准"] / decided, 拒絕率=table["拒絕"] / decided)
+
+    def lead_table(self):
+        return pd.DataFrame(self.lead.T, index=LEAD_TIME_LABELS, columns=STATUS_OPTIONS)
+
+    def mean_lead_days(self):
+        return dict(zip(STATUS_OPTIONS, self.lead_days / np.maximum(self.lead.sum(axis=1), 1)))
+
+def get_usage_stats():
+    # 第一次打開時用快照加上全部封存預約建一份；之後的寫入、重讀由 SnapshotCache 增量更新
+    cache = get_snapshot_cache()
+    load_snapshot()
+    with cache.lock:
+        if cache.usage is not None or cache.snapshot is None:
+            return cache.usage or UsageStats()
+        snapshot = cache.snapshot
+        token = cache.revisions.get("archive")
+    usage = UsageStats()
+    usage.add_frame(snapshot.bookings)
+    try:
+        with cache.archive_lock:
+            archived = cache.backend.read_archive(1, archive_cutoff(), token)
+        usage.add_frame(normalize_bookings(archived))
+    except Exception as e:
+        st.warning(f"封存資料讀取失敗，統計只含近期預約: {e}")
+        return usage  # 不快取，下次再試
+    with cache.lock:
+        # 建的期間快照或封存區換過就不快取 (這份沒跟上那些變動)，下次重建
+        unchanged = cache.snapshot is snapshot and cache.revisions.get("archive") == token
+        if cache.usage is None and unchanged:
+            cache.usage = usage
+    return usage
+
+# --- ⚡ 批次審核 ---
+SLOT_SPAN = 2 * 24 * 60  # (日期, 地點) 鍵乘上這個數再加分鐘數，合成一個可排序的整數
+
+def _slot_keys(frame, rooms):
+    return frame["day"].to_numpy(np.int64) * len(rooms) + rooms.get_indexer(frame['會議地點'])
+
+def overlaps_any(a, a_keys, b, b_keys):
+    # a 的每一列是否與 b 中同日同地點的任一列時段重疊；b 依 (鍵, 開始) 排序後用累積最大結束時間一次比完
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(len(a), dtype=bool)
+    b_start = b["start"].to_numpy(np.int64)
+    order = np.lexsort((b_start, b_keys))
+    base = b_keys[order] * SLOT_SPAN
+    starts = base + b_start[order]
+    reach = np.maximum.accumulate(base + b["end"].to_numpy(np.int64)[order])
+    a_base = a_keys * SLOT_SPAN
+    # 開始早於 a 結束的 (含較小的鍵)
+    n = np.searchsorted(starts, a_base + a["end"].to_numpy(np.int64), side="left")
+    return (n > 0) & (reach[np.maximum(n - 1, 0)] > a_base + a["start"].to_numpy(np.int64))
+
+def plan_bulk_review(frame, candidates):
+    # frame: _calendar_frame；candidates: 要核准的編號 -> (核准, 拒絕, 其中與已核准衝突的)
+    # 與已核准重疊的直接拒絕；剩下彼此重疊的，同一串重疊裡依登記時間先到先得
+    rooms = pd.Index(frame['會議地點'].unique())
+    cand = frame.loc[frame.index.intersection(candidates)]
+    approved = frame[(frame['狀態'] == '核准') & ~frame.index.isin(cand.index)]
+    clash = overlaps_any(cand, _slot_keys(cand, rooms), approved, _slot_keys(approved, rooms))
+    rest = cand[~clash]
+    keys = _slot_keys(rest, rooms)
+    order = np.lexsort((rest["start"].to_numpy(np.int64), keys))
+    rest = rest.iloc[order]
+    keys = keys[order]
+    base = keys * SLOT_SPAN
+    ends = base + rest["end"].to_numpy(np.int64)
+    prev_reach = np.concatenate([[-1], np.maximum.accumulate(ends)[:-1]])
+    cluster = np.cumsum(~(prev_reach > base + rest["start"].to_numpy(np.int64)))  # 與前面重疊就併入同一串
+    sizes = np.bincount(cluster)[cluster]
+    approve = list(rest.index[sizes == 1])
+    reject = list(cand.index[clash])
+    contested = rest[sizes > 1].assign(cluster=cluster[sizes > 1])
+    contested = contested.sort_values(["cluster", '登記時間'], kind="stable")
+    for _, group in contested.groupby("cluster", sort=False):
+        taken = []
+        for booking_id, start, end in zip(group.index, group["start"], group["end"]):
+            if any(start < e and end > s for s, e in taken):
+                reject.append(booking_id)
+            else:
+                taken.append((start, end))
+                approve.append(booking_id)
+    return approve, reject, list(cand.index[clash])
+
+def _bulk_scope(snapshot, rooms, span):
+    frame = _calendar_frame(snapshot.bookings, snapshot.version)
+    lo, hi = frame["day"].searchsorted([span[0].toordinal(), span[1].toordinal() + 1])
+    scope = frame.iloc[lo:hi]
+    pending = scope.index[(scope['狀態'] == '待審核') & scope['會議地點'].isin(rooms)]
+    return (pending,) + tuple(plan_bulk_review(frame, pending))
+
+def bulk_review_panel():
+    with st.expander("⚡ 批次審核"):
+        c1, c2 = st.columns(2)
+        rooms = c1.multiselect("地點", LOCATION_OPTIONS, default=LOCATION_OPTIONS, key="bulk_rooms")
+        span = c2.date_input("日期範圍", value=(date.today(), date.today() + timedelta(days=30)), key="bulk_span")
+        if len(span) != 2:
+            return
+        pending, approve, reject, clash = _bulk_scope(load_snapshot(), rooms, span)
+        st.caption(f"符合條件的待審核：{len(pending)} 筆；與已核准衝突 {len(clash)} 筆，"
+                   f"彼此衝突而落選 {len(reject) - len(clash)} 筆")
+        b1, b2, b3 = st.columns(3)
+        clicked = {
+            "approve": b1.button("✅ 核准 (衝突者拒絕)", use_container_width=True, disabled=not len(pending)),
+            "clash": b2.button("🧹 拒絕與已核准衝突者", use_container_width=True, disabled=not clash),
+            "reject": b3.button("🚫 全部拒絕", use_container_width=True, disabled=not len(pending)),
+        }
+        action = next((k for k, v in clicked.items() if v), None)
+        if action is None:
+            return
+        # 以最新資料重算
+        pending, approve, reject, clash = _bulk_scope(load_snapshot(check_interval=0), rooms, span)
+        if action == "approve":
+            updates = {k: {"狀態": "核准"} for k in approve}
+            updates.update({k: {"狀態": "拒絕"} for k in reject})
+        elif action == "clash":
+            updates = {k: {"狀態": "拒絕"} for k in clash}
+        else:
+            updates = {k: {"狀態": "拒絕"} for k in pending}
+        if update_bookings(updates):
+            st.session_state.pop("admin_base", None)
+            st.rerun()
+
+# --- 🔁 週期預約 ---
+REPEAT_STEPS = {"不重複": 0, "每天": 1, "每週": 7}
+MAX_OCCURRENCES = 52
+
+def recurrence_dates(first, repeat, count, until=None):
+    # 重複 count 次，或排到 until 為止 (有填 until 就不看 count)；兩種都最多 MAX_OCCURRENCES 次
+    step = REPEAT_STEPS.get(repeat, 0)
+    if not step:
+        return [first]
+    if until is None:
+        n = int(count)
+    elif until < first:
+        return []
+    else:
+        n = (until - first).days // step + 1
+    return [first + timedelta(days=step * k) for k in range(min(n, MAX_OCCURRENCES))]
+
+def check_series_overlap(snapshot, dates, start_t, end_t, location):
+    # 整個系列一次比對現有預約 (拒絕的不算)，回傳每個日期是否衝突
+    frame = _calendar_frame(snapshot.bookings, snapshot.version)
+    existing = frame[frame['狀態'] != '拒絕']
+    series = pd.DataFrame({
+        "day": [d.toordinal() for d in dates],
+        "start": time_to_minutes(start_t),
+        "end": time_to_minutes(end_t),
+        "會議地點": location,
+    })
+    rooms = pd.Index(pd.concat([existing['會議地點'], series['會議地點']]).unique())
+    return overlaps_any(series, _slot_keys(series, rooms), existing, _slot_keys(existing, rooms))
 
 # --- 彈跳視窗 ---
 @st.dialog("🎉 申請成功！")
 def show_success_message():
     st.subheader("Thank You! 💖")
     st.write("已通知主管進行審核。")
-    thank_you_file = None
-    for ext in ["jpg", "jpeg", "png"]:
-        if os.path.exists(f"thank_you.{ext}"):
-            thank_you_file = f"thank_you.{ext}"
-            break
-    if thank_you_file:
-        try:
-            img = Image.open(thank_you_file)
-            st.image(img, use_container_width=True)
-        except: pass
+    thank_you = load_asset(THANK_YOU_FILES, 1000)
+    if thank_you:
+        st.image(thank_you, use_container_width=True)
     st.balloons()
     if st.button("好的，我知道了", type="primary"): st.rerun()
 
@@ -461,58 +2312,100 @@ def show_event_details(event_props):
     st.write("---")
     st.caption("⚠️ 操作區")
     if st.button("🗑️ 我要取消這個預約", type="primary", use_container_width=True, help="請確認這是您的預約再刪除"):
-        current_df = load_data()
-        if not current_df.empty:
-            mask = (
-                (current_df['日期'] == event_props.get('raw_date')) & 
-                (current_df['開始時間'] == event_props.get('raw_start')) & 
-                (current_df['結束時間'] == event_props.get('raw_end')) & 
-                (current_df['會議地點'] == event_props.get('location'))
-            )
-            
-            if not current_df[mask].empty:
-                row_to_delete = current_df[mask].iloc[0]
-                new_df = current_df[~mask]
-                save_data(new_df)
-                with st.spinner("正在取消並發送通知..."):
-                    send_deletion_email(row_to_delete)
+        current_df = load_snapshot(check_interval=0).bookings
+        booking_id = event_props.get('id')
+        if booking_id in current_df.index:
+            row_to_delete = booking_rows(current_df.loc[[booking_id]]).iloc[0]
+            if delete_bookings([booking_id]):
+                send_deletion_email(row_to_delete)
                 st.success("預約已取消！")
                 st.rerun()
-            else:
-                st.error("❌ 找不到此預約，可能已經被刪除了。")
-
-# --- 主程式 ---
-st.sidebar.header("🔒 管理員專區")
-if "admin_pass_input" not in st.session_state: st.session_state["admin_pass_input"] = ""
-def logout(): st.session_state["admin_pass_input"] = ""
-admin_pwd = st.sidebar.text_input("輸入密碼", type="password", key="admin_pass_input")
-is_admin = admin_pwd == ADMIN_PASSWORD
+        else:
+            st.error("❌ 找不到此預約，可能已經被刪除了。")
 
-if is_admin:
-    st.sidebar.success("✅ 管理員已登入")
-    if st.sidebar.button("🚪 登出 / 回首頁"): logout(); st.rerun()
-    
-    st.markdown(f"<h3 style='color:{THEME_COLOR}'>📋 審核後台</h3>", unsafe_allow_html=True)
-    load_data.clear(); df = load_data()
+# --- 🧩 後台與預約表單 (各自獨立重跑) ---
+@st.fragment
+@measured("後台")
+def admin_panel():
+    # 表格編輯只重跑這一區；儲存成功後整頁重跑，讓行事曆一起更新
+    bulk_review_panel()
+    with st.expander("📚 歷史紀錄查詢"):
+        span = st.date_input("日期範圍", value=(date.today() - timedelta(days=90), date.today()), key="history_span")
+        if len(span) == 2:
+            history = load_history(span[0].toordinal(), span[1].toordinal() + 1)
+            st.caption(f"共 {len(history)} 筆")
+            st.dataframe(booking_rows(history), hide_index=True, use_container_width=True)
+    # 編輯中 (表格有未儲存的修改) 就固定用開始編輯時的資料，避免別人新增的列讓表格的列位置錯開
+    editor_state = st.session_state.get("admin") or {}
+    editing = any(editor_state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+    if "admin_base" not in st.session_state or not editing:
+        st.session_state["admin_base"] = editor_frame(load_data())
+    df = st.session_state["admin_base"]
     if not df.empty:
-        df["刪除"] = False
+        df = df.assign(刪除=False)
         edited_df = st.data_editor(
             df, 
             column_config={
-                "狀態": st.column_config.SelectboxColumn("狀態", options=["待審核", "核准", "拒絕"], required=True),
+                "日期": st.column_config.DateColumn("日期", format="YYYY-MM-DD"),
+                "開始時間": st.column_config.TimeColumn("開始時間", format="HH:mm", step=1800),
+                "結束時間": st.column_config.TimeColumn("結束時間", format="HH:mm", step=1800),
+                "狀態": st.column_config.SelectboxColumn("狀態", options=STATUS_OPTIONS, required=True),
                 "會議地點": st.column_config.TextColumn(disabled=True),
                 "與會人": st.column_config.TextColumn("與會人"),
+                "編號": st.column_config.TextColumn(disabled=True),
                 "刪除": st.column_config.CheckboxColumn(label="🗑️ 刪除", help="勾選並儲存以刪除資料")
             },
-            num_rows="dynamic", key="admin", use_container_width=True
+            num_rows="dynamic", key="admin", hide_index=True, use_container_width=True
         )
         if st.button("💾 儲存變更", type="primary", use_container_width=True):
-            final_df = edited_df[edited_df["刪除"] == False]
-            final_df = final_df.drop(columns=["刪除"])
-            save_data(final_df)
-            st.success("已更新")
-            st.rerun()
-else:
+            appends, updates, deletes = diff_bookings(st.session_state["admin_base"], edited_df)
+            if not appends and not updates and not deletes:
+                st.info("沒有需要儲存的變更")
+            elif apply_booking_changes(appends, updates, deletes):
+                del st.session_state["admin_base"]
+                st.success("已更新")
+                st.rerun()
+
+def heat_style(table):
+    # 佔用率表格 -> 依數值深淺塗主題色 (以表內最大值為最深)
+    peak = max(table.to_numpy().max(), 1e-9)
+
+    def shade(v):
+        if v <= 0:
+            return ""
+        return f"background-color: {THEME_COLOR}{int(min(v / peak, 1) * 255):02x}"
+    return table.style.format("{:.0%}").map(shade)
+
+@st.fragment
+@measured("使用率分析")
+def analytics_panel():
+    # 全部由 UsageStats 的累計計數算出，多年資料也不必重掃
+    with st.expander("📈 會議室使用率分析", expanded=False):
+        usage = get_usage_stats()
+        if usage.first_day is None:
+            return st.caption("還沒有預約資料")
+        st.caption(f"統計期間 {date.fromordinal(usage.first_day)} ~ {date.fromordinal(usage.last_day)} (含封存)")
+        c1, c2 = st.columns(2)
+        statuses = c1.multiselect("計入的狀態", STATUS_OPTIONS, default=["核准"], key="usage_statuses")
+        room = c2.selectbox("地點", ["全部地點"] + LOCATION_OPTIONS, key="usage_room")
+        if not statuses:
+            return st.info("請至少選一個狀態")
+        st.markdown(f"**{room}：星期 × 時段佔用率**")
+        utilization = usage.utilization(statuses, None if room == "全部地點" else room)
+        st.dataframe(heat_style(utilization), use_container_width=True)
+        st.markdown("**各地點 × 星期平均佔用率**")
+        st.dataframe(heat_style(usage.room_utilization(statuses)), use_container_width=True)
+        c3, c4 = st.columns(2)
+        c3.markdown("**審核結果**")
+        status_table = usage.status_table().style.format("{:.0%}", subset=["核准率", "拒絕率"], na_rep="-")
+        c3.dataframe(status_table, use_container_width=True)
+        c4.markdown("**提前幾天預約**")
+        c4.dataframe(usage.lead_table(), use_container_width=True)
+        c4.caption("平均提前：" + "、".join(f"{s} {d:.1f} 天" for s, d in usage.mean_lead_days().items()))
+
+@st.fragment
+@measured("預約表單")
+def booking_form():
     with st.expander("➕ 申請預約 (需審核)", expanded=True):
         with st.form("booking_form"):
             c1, c2 = st.columns(2)
@@ -528,76 +2421,162 @@ else:
             c5, c6 = st.columns(2)
             s_time = c5.selectbox("開始", TIME_OPTIONS, index=0)
             e_time = c6.selectbox("結束", TIME_OPTIONS, index=2)
+            c7, c8, c9 = st.columns(3)
+            repeat = c7.selectbox("重複", list(REPEAT_STEPS))
+            count = c8.number_input("次數", min_value=1, max_value=MAX_OCCURRENCES, value=4,
+                                    help="沒填「直到」時重複幾次")
+            until = c9.date_input("直到 (選填)", value=None, min_value=datetime.today(),
+                                  help=f"填了就排到這天為止，不看次數 (最多 {MAX_OCCURRENCES} 次)")
             content = st.text_input("內容 (必填)")
             if st.form_submit_button("送出", use_container_width=True):
-                load_data.clear(); df = load_data()
-                if not name or not content: st.error("❌ 請填寫必填欄位")
-                elif s_time >= e_time: st.error("❌ 時間錯誤：結束時間必須晚於開始時間")
-                else:
-                    conflict = check_overlap(df, date_val, s_time, e_time)
-                    if conflict: st.error(f"❌ 衝突：該時段已被「{conflict}」預約")
+                snapshot = load_snapshot(check_interval=0)
+                dates = recurrence_dates(date_val, repeat, count, until)
+                new_row = {
+                    "日期": date_val.strftime("%Y-%m-%d"),
+                    "開始時間": s_time.strftime("%H:%M:%S"),
+                    "結束時間": e_time.strftime("%H:%M:%S"),
+                    "大名": name,
+                    "與會人": attendees,
+                    "會議地點": loc,
+                    "預約內容": content,
+                    "登記時間": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "狀態": "待審核",
+                }
+                if not name or not content:
+                    st.error("❌ 請填寫必填欄位")
+                elif get_snapshot_cache().error:
+                    st.error("❌ 目前讀不到最新的預約資料，無法檢查時段衝突，請稍後再試")
+                elif s_time >= e_time:
+                    st.error("❌ 時間錯誤：結束時間必須晚於開始時間")
+                elif not dates:
+                    st.error("❌ 「直到」的日期早於第一次會議")
+                elif len(dates) > 1:
+                    clash = check_series_overlap(snapshot, dates, s_time, e_time, loc)
+                    free = [d for d, c in zip(dates, clash) if not c]
+                    taken = [d for d, c in zip(dates, clash) if c]
+                    if not free:
+                        st.error("❌ 衝突：整個系列的時段都已被預約")
                     else:
-                        new_row = {"日期": date_val.strftime("%Y-%m-%d"), "開始時間": s_time.strftime("%H:%M:%S"), "結束時間": e_time.strftime("%H:%M:%S"), "大名": name, "與會人": attendees, "會議地點": loc, "預約內容": content, "登記時間": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "狀態": "待審核"}
-                        save_data(pd.concat([df, pd.DataFrame([new_row])], ignore_index=True))
-                        send_notification_email(new_row); show_success_message()
+                        rows = [{**new_row, "日期": d.strftime("%Y-%m-%d")} for d in free]
+                        if append_bookings(rows):
+                            if taken:
+                                st.warning("⚠️ 以下日期已被預約，已略過：" + "、".join(d.strftime("%m/%d") for d in taken))
+                            next_date = dates[-1] + timedelta(days=REPEAT_STEPS[repeat])
+                            if until and len(dates) == MAX_OCCURRENCES and next_date <= until:
+                                st.warning(f"⚠️ 一次最多 {MAX_OCCURRENCES} 次，只排到 {dates[-1]:%Y/%m/%d}")
+                            send_notification_email(rows[0], [row["日期"] for row in rows])
+                            show_success_message()
+                else:
+                    conflict = check_overlap(snapshot, date_val, s_time, e_time, loc)
+                    if conflict:
+                        st.error(f"❌ 衝突：該時段已被「{conflict}」預約")
+                        busy = day_availability(snapshot, date_val.toordinal())
+                        times, rooms = suggest_slots(busy, loc, s_time, e_time)
+                        tips = []
+                        if times:
+                            tips.append(f"{loc} 其他時段：" + "、".join(f"{a:%H:%M}-{b:%H:%M}" for a, b in times))
+                        if rooms:
+                            tips.append("同時段空著的地點：" + "、".join(rooms))
+                        if tips:
+                            st.info("💡 " + "；".join(tips))
+                    elif append_bookings([new_row]):
+                        send_notification_email(new_row)
+                        show_success_message()
+    with st.expander("🔎 查詢空檔", expanded=False):
+        day = st.date_input("想預約的日期", min_value=datetime.today(), key="availability_date")
+        busy = day_availability(load_snapshot(), day.toordinal())
+        st.dataframe(availability_table(busy), use_container_width=True)
+
+# --- 主程式 ---
+with measure_section("封存整理"):
+    compact_bookings()
+load_snapshot()
+snapshot_cache = get_snapshot_cache()
+if snapshot_cache.error:
+    if snapshot_cache.snapshot is None:
+        st.error(f"⚠️ 目前無法讀取預約資料，請稍後重新整理 ({snapshot_cache.error})")
+    else:
+        shown = datetime.fromtimestamp(snapshot_cache.checked_at)
+        st.warning(f"⚠️ 資料暫時無法更新，顯示的是 {shown:%H:%M:%S} 的資料 ({snapshot_cache.error})")
+st.sidebar.header("🔒 管理員專區")
+if "admin_pass_input" not in st.session_state: st.session_state["admin_pass_input"] = ""
+def logout(): st.session_state["admin_pass_input"] = ""
+admin_pwd = st.sidebar.text_input("輸入密碼", type="password", key="admin_pass_input")
+is_admin = admin_pwd == ADMIN_PASSWORD
+
+if is_admin:
+    st.sidebar.success("✅ 管理員已登入")
+    st.sidebar.caption(f"🗄️ 資料儲存：{get_backend().name}")
+    mail_config = _email_config()
+    if mail_config:
+        failed_mails = get_mail_outbox(mail_config).failed_count()
+        if failed_mails:
+            st.sidebar.warning(f"📮 有 {failed_mails} 封通知信寄送失敗，請檢查寄信設定")
+    compaction_error = _compaction_state()["error"]
+    if compaction_error:
+        st.sidebar.warning(f"🗃️ 今天的封存整理失敗，明天會再試 ({compaction_error})")
+    if st.sidebar.button("🚪 登出 / 回首頁"): logout(); st.rerun()
+    
+    st.markdown(f"<h3 style='color:{THEME_COLOR}'>📋 審核後台</h3>", unsafe_allow_html=True)
+    admin_panel()
+    analytics_panel()
+else:
+    booking_form()
 
 st.markdown(f"<hr style='border-top: 2px dashed {THEME_COLOR};'>", unsafe_allow_html=True)
 
 # --- 行事曆 ---
-df = load_data()
-current_view = "timeGridWeek"
-
-events = []
 if "calendar_date" not in st.session_state:
     st.session_state["calendar_date"] = datetime.today().isoformat()
 
-if not df.empty and '日期' in df.columns:
-    for _, row in df.iterrows():
-        try:
-            status = row.get('狀態', '核准')
-            if not is_admin and status != '核准': continue
-            clean_date = str(row['日期']).replace('/', '-').strip()
-            start_t = fix_time(row['開始時間']); end_t = fix_time(row['結束時間'])
-            if not start_t or not end_t: continue
-            loc = row.get('會議地點', '未指定'); bg_color = THEME_COLOR
-            if status == '待審核': bg_color = "#F39C12"
-            elif status == '拒絕': bg_color = "#7F8C8D"
-            title_text = f"[{loc}] {row['大名']}"
-            if is_admin: title_text = f"({status}) {title_text}"
-            
-            events.append({
-                "title": title_text, "start": f"{clean_date}T{start_t}", "end": f"{clean_date}T{end_t}",
-                "backgroundColor": bg_color, "borderColor": bg_color, "textColor": "#FFFFFF",
-                "extendedProps": {
-                    "location": loc, 
-                    "name": row['大名'], 
-                    "attendees": row.get('與會人', ''), 
-                    "content": row['預約內容'], 
-                    "status": status, 
-                    "pretty_time": f"{start_t[:5]} - {end_t[:5]}",
-                    "raw_date": row['日期'],
-                    "raw_start": row['開始時間'],
-                    "raw_end": row['結束時間']
-                }
-            })
-        except: continue
-
-calendar_options = {
-    "initialView": current_view,
-    "headerToolbar": {"left": "today prev,next", "center": "title", "right": ""},
-    "height": "auto", "slotMinTime": "08:00:00", "slotMaxTime": "19:00:00", "allDaySlot": False,
-    "initialDate": st.session_state["calendar_date"],
-}
+@st.fragment
+@measured("行事曆")
+def calendar_panel(is_admin):
+    # 換週只重跑行事曆，不會重讀笑話與心情
+    from streamlit_calendar import calendar
+    snapshot = load_snapshot()
+    current_view = "timeGridWeek"
+    calendar_key = f"calendar_{current_view}"
 
-calendar_state = calendar(events=events, options=calendar_options, key=f"calendar_{current_view}", callbacks=["datesSet", "eventClick"])
+    # 換週的 datesSet 在畫行事曆之前就讀進來，這一輪直接給新的一週，不必畫完再重跑一次
+    dates_set = (st.session_state.get(calendar_key) or {}).get("datesSet")
+    if dates_set and dates_set["startStr"][:10] != st.session_state["calendar_date"][:10]:
+        st.session_state["calendar_date"] = dates_set["startStr"]
 
-if calendar_state.get("datesSet"):
-    new_start_date = calendar_state["datesSet"]["startStr"]
-    if new_start_date.split("T")[0] != st.session_state["calendar_date"].split("T")[0]:
-        st.session_state["calendar_date"] = new_start_date
-        st.rerun()
+    anchor = week_anchor(st.session_state["calendar_date"])
+    first_day, last_day = anchor - 7 * PREFETCH_WEEKS, anchor + 7 * (PREFETCH_WEEKS + 1)
+    archive_revision = get_snapshot_cache().revisions.get("archive")
+    frames = [_calendar_frame(snapshot.bookings, snapshot.version)]
+    if first_day < archive_cutoff():  # 往前翻到已封存的月份才去讀封存分區
+        archived = archived_bookings(first_day, min(last_day, archive_cutoff()))
+        frames.append(_calendar_frame(archived, f"archive-{archive_revision}-{first_day}"))
+    started = time_module.perf_counter()
+    build = functools.partial(week_events, frames, is_admin=is_admin)
+    events, hit = session_calendar_weeks().events((snapshot.version, archive_revision, is_admin), anchor, build)
+    get_metrics().record_cache("行事曆週", hit, started)
+
+    calendar_options = {
+        "initialView": current_view,
+        "headerToolbar": {"left": "today prev,next", "center": "title", "right": ""},
+        "height": "auto", "slotMinTime": "08:00:00", "slotMaxTime": "19:00:00", "allDaySlot": False,
+        "initialDate": st.session_state["calendar_date"],
+    }
 
-if calendar_state.get("eventClick"):
-    show_event_details(calendar_state["eventClick"]["event"]["extendedProps"])
+    calendar_state = calendar(events=events, options=calendar_options, key=calendar_key, callbacks=["datesSet", "eventClick"])
+
+    if calendar_state.get("datesSet"):
+        new_start_date = calendar_state["datesSet"]["startStr"]
+        if new_start_date.split("T")[0] != st.session_state["calendar_date"].split("T")[0]:
+            st.session_state["calendar_date"] = new_start_date
+            rerun_fragment()
+
+    if calendar_state.get("eventClick"):
+        show_event_details(calendar_state["eventClick"]["event"]["extendedProps"])
+
+calendar_panel(is_admin)
 
 if is_admin: st.caption(f"🟦 核准 | 🟧 待審核 | ⬜ 拒絕")
+
+get_metrics().end_run()
+if is_admin:
+    metrics_panel()